@@ -0,0 +1,177 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed for BACKUP_CODEC=zstd
+    zstandard = None
+
+# Compressed backup files, their catalog and retention. Works on plain paths
+# so both the local backups/ directory and the Drive upload can use it.
+BACKUP_CODEC = os.getenv("BACKUP_CODEC", "gzip").lower()
+BACKUP_COMPRESSION_LEVEL = int(os.getenv("BACKUP_COMPRESSION_LEVEL", "6"))
+# Tiered retention: newest backup of each of the last N hours / days / months
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "30"))
+BACKUP_KEEP_MONTHLY = int(os.getenv("BACKUP_KEEP_MONTHLY", "12"))
+
+CATALOG_NAME = "catalog.json"
+CODEC_SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_catalog_lock = threading.Lock()
+
+
+# === Codecs ===
+def active_codec() -> str:
+    if BACKUP_CODEC == "zstd" and zstandard is None:
+        print("⚠️ BACKUP_CODEC=zstd but the zstandard package is not installed; using gzip.")
+        return "gzip"
+    return BACKUP_CODEC if BACKUP_CODEC in CODEC_SUFFIXES else "gzip"
+
+
+def codec_for(name: str) -> str:
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if suffix and name.endswith(suffix):
+            return codec
+    return "none"
+
+
+def _open_writer(path: str, codec: str):
+    if codec == "gzip":
+        return gzip.open(path, "wb", compresslevel=BACKUP_COMPRESSION_LEVEL)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=BACKUP_COMPRESSION_LEVEL).stream_writer(open(path, "wb"), closefd=True)
+    return open(path, "wb")
+
+
+def _open_reader(path: str, codec: str):
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def compress_file(src_path: str, dest_path: str, codec: str) -> None:
+    """Stream ``src_path`` into ``dest_path`` through ``codec``."""
+    with open(src_path, "rb") as src, _open_writer(dest_path, codec) as out:
+        shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+
+
+def decompress_file(src_path: str, dest_path: str, codec: Optional[str] = None) -> None:
+    """Inverse of compress_file(); the codec defaults to the one named by the suffix."""
+    with _open_reader(src_path, codec or codec_for(src_path)) as src, open(dest_path, "wb") as out:
+        shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# === Catalog ===
+# backups/catalog.json lists every backup, oldest first:
+#   {"name", "created", "codec", "sha256", "size", "db_bytes", "rows"}
+def load_catalog(directory: str) -> List[Dict]:
+    try:
+        with open(os.path.join(directory, CATALOG_NAME)) as f:
+            return json.load(f)["backups"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def _save_catalog(directory: str, entries: List[Dict]):
+    path = os.path.join(directory, CATALOG_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"backups": entries}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def archive_snapshot(snapshot_path: str, directory: str, name_stem: str, rows: int) -> Dict:
+    """Compress a finished snapshot into ``directory``, record it in the catalog and prune."""
+    codec = active_codec()
+    name = f"{name_stem}.db{CODEC_SUFFIXES[codec]}"
+    path = os.path.join(directory, name)
+    # Unique per call: two backups within the same second share ``name``
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        compress_file(snapshot_path, tmp_path, codec)
+        entry = {
+            "name": name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "codec": codec,
+            "sha256": file_sha256(tmp_path),
+            "size": os.path.getsize(tmp_path),
+            "db_bytes": os.path.getsize(snapshot_path),
+            "rows": rows,
+        }
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    with _catalog_lock:
+        entries = [e for e in load_catalog(directory) if e["name"] != name] + [entry]
+        keep = retained({e["name"]: datetime.fromisoformat(e["created"]) for e in entries}.items())
+        for e in entries:
+            if e["name"] not in keep:
+                try:
+                    os.remove(os.path.join(directory, e["name"]))
+                except FileNotFoundError:
+                    pass
+        _save_catalog(directory, [e for e in entries if e["name"] in keep])
+    return entry
+
+
+def latest_valid_backup(directory: str) -> Optional[Dict]:
+    """Newest catalogued backup whose file is present and matches its checksum."""
+    for entry in reversed(load_catalog(directory)):
+        path = os.path.join(directory, entry["name"])
+        try:
+            if os.path.getsize(path) == entry["size"] and file_sha256(path) == entry["sha256"]:
+                return entry
+        except OSError:
+            pass
+        print(f"⚠️ Skipping backup {entry['name']}: missing or checksum mismatch.")
+    return None
+
+
+# === Retention ===
+def retained(items: Iterable[Tuple[str, datetime]], hourly: int = None, daily: int = None,
+             monthly: int = None) -> Set[str]:
+    """Names to keep from ``(name, created)`` pairs under the hourly/daily/monthly tiers.
+
+    Each tier keeps the newest backup of each of its most recent N periods;
+    the newest backup overall is always kept.
+    """
+    tiers = (
+        ("%Y%m%d%H", BACKUP_KEEP_HOURLY if hourly is None else hourly),
+        ("%Y%m%d", BACKUP_KEEP_DAILY if daily is None else daily),
+        ("%Y%m", BACKUP_KEEP_MONTHLY if monthly is None else monthly),
+    )
+    newest_first = sorted(items, key=lambda item: item[1], reverse=True)
+    keep = {newest_first[0][0]} if newest_first else set()
+    for period_format, count in tiers:
+        periods = set()
+        for name, created in newest_first:
+            period = created.strftime(period_format)
+            if period in periods:
+                continue
+            if len(periods) >= count:
+                break
+            periods.add(period)
+            keep.add(name)
+    return keep
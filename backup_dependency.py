@@ -1,29 +1,62 @@
-from fastapi import BackgroundTasks, Depends
+from fastapi import Depends, HTTPException
 # Import your existing upload function
-from drive_uploader import upload_to_drive
-from database_utils import DB_PATH
+from drive_uploader import upload_to_drive, prune_drive_backups, BACKUP_MODE, DRIVE_SYNC_LOCK, DRIVE_RESTORE
+from backup_archive import active_codec, compress_file, CODEC_SUFFIXES
+from delta_backup import ship_delta_backup
+from database_utils import DB_PATH, db_snapshot, on_write_committed
 import os
-from pathlib import Path
+import time
+import threading
+from typing import Dict, Optional
 
 # --- Configuration ---
 
-DRIVE_FILENAME = "bills_backup.db"
+DRIVE_FILENAME = "bills_backup"
+# Writes closer together than this are folded into one upload...
+BACKUP_DEBOUNCE_SECONDS = float(os.getenv("BACKUP_DEBOUNCE_SECONDS", "30"))
+# ...but a steady stream of writes still gets uploaded at least this often
+BACKUP_MAX_STALENESS_SECONDS = float(os.getenv("BACKUP_MAX_STALENESS_SECONDS", "300"))
+# Wait before trying again after a failed upload
+BACKUP_RETRY_SECONDS = float(os.getenv("BACKUP_RETRY_SECONDS", "60"))
 
 
 # 1. Internal Task Execution Function
-def _perform_background_backup():
+def _perform_background_backup() -> bool:
     """Internal function that executes the backup and handles logging/errors."""
     try:
         print(f"⏳ Background task: Searching for DB at path: {DB_PATH}") # 👈 Add this line
-        
-        # Call your existing function
-        file_id = upload_to_drive(DB_PATH, DRIVE_FILENAME)
-        
+
+        if not os.path.exists(DB_PATH):
+            print("⚠️ No database found to back up.")
+            return False
+
+        # Waits out a running restore: the database is about to be replaced
+        with DRIVE_SYNC_LOCK:
+            if BACKUP_MODE == "delta":
+                # Only the pages changed since the last upload (see delta_backup.py)
+                return ship_delta_backup()
+
+            # Upload a finished snapshot, never the live file writers are changing
+            with db_snapshot() as snapshot_path:
+                codec = active_codec()
+                compressed_path = snapshot_path + ".upload" + CODEC_SUFFIXES[codec]
+                try:
+                    compress_file(snapshot_path, compressed_path, codec)
+                    file_name = f"{DRIVE_FILENAME}_{time.strftime('%Y%m%d_%H%M%S')}.db{CODEC_SUFFIXES[codec]}"
+                    # Call your existing function
+                    file_id = upload_to_drive(compressed_path, file_name)
+                finally:
+                    if os.path.exists(compressed_path):
+                        os.remove(compressed_path)
+
         if file_id:
             print("✅ Background DB backup completed successfully.")
+            prune_drive_backups()
+            return True
         else:
             # If upload_to_drive returns False, log it
             print("❌ Background DB backup failed (Function returned False).")
+            return False
 
     except Exception as e:
         # ⚠️ CRITICAL CHANGE: Catch ALL exceptions here.
@@ -31,19 +64,172 @@ def _perform_background_backup():
         print(f"❌ CRITICAL BACKGROUND ERROR: Database upload failed due to uncaught exception: {type(e).__name__}: {e}")
         # Optionally, log the traceback to a dedicated log file if necessary.
         # This keeps the main application logs clean.
+        return False
+
+
+# 2. The Scheduler (one upload for many writes)
+class BackupScheduler:
+    """Single worker thread that uploads the database once per burst of writes.
+
+    request_backup() only marks the database dirty. The worker uploads when
+    no write has arrived for ``debounce`` seconds, or when the oldest
+    un-uploaded write is ``max_staleness`` seconds old, whichever is first.
+    Each upload ships the state at upload time, which covers every write
+    requested before it started.
+    """
+
+    def __init__(self, backup=_perform_background_backup, debounce: float = BACKUP_DEBOUNCE_SECONDS,
+                 max_staleness: float = BACKUP_MAX_STALENESS_SECONDS, retry: float = BACKUP_RETRY_SECONDS):
+        self.backup = backup
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.retry = retry
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._expedite = False
+        self._running = False
+        # Writes waiting for an upload, and when the first / latest arrived
+        self._pending = 0
+        self._first_request: Optional[float] = None
+        self._last_request: Optional[float] = None
+        self._not_before = 0.0
+        self.uploads = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.last_success: Optional[float] = None
+        self.last_failure: Optional[float] = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._worker, name="drive-backup", daemon=True)
+            self._thread.start()
+
+    def request_backup(self):
+        """Note a committed write; cheap enough to call from any request."""
+        now = time.time()
+        with self._cond:
+            self._pending += 1
+            if self._first_request is None:
+                self._first_request = now
+            self._last_request = now
+            self._cond.notify()
 
+    def expedite(self):
+        """Upload pending writes now instead of waiting out the debounce window."""
+        with self._cond:
+            if self._pending:
+                self._expedite = True
+                self._cond.notify()
 
-# 2. The FastAPI Dependency (The Queuer)
-def queue_backup_on_write(background_tasks: BackgroundTasks):
+    def _due_in(self, now: float) -> float:
+        # Seconds until the pending writes should be uploaded (0 = now)
+        if self._expedite or self._stopping:
+            return 0.0
+        due = min(self._last_request + self.debounce, self._first_request + self.max_staleness)
+        return max(due, self._not_before) - now
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._pending:
+                        wait = self._due_in(time.time())
+                        if wait <= 0:
+                            break
+                    elif self._stopping:
+                        return
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                batch = self._pending
+                self._pending = 0
+                self._first_request = self._last_request = None
+                self._expedite = False
+                self._running = True
+
+            print(f"☁️ Uploading backup for {batch} write(s).")
+            ok = self.backup()
+
+            with self._cond:
+                self._running = False
+                if ok:
+                    self.uploads += 1
+                    self.coalesced += batch - 1
+                    self.last_success = time.time()
+                else:
+                    self.failures += 1
+                    self.last_failure = time.time()
+                    # Put the writes back; they are retried after a pause
+                    self._pending += batch
+                    now = time.time()
+                    self._first_request = self._first_request or now
+                    self._last_request = self._last_request or now
+                    self._not_before = now + self.retry
+                    if self._stopping:
+                        # No more retries when shutting down
+                        self._pending = 0
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Upload anything pending and stop the worker; for application shutdown.
+
+        Returns False if the upload did not finish within ``timeout``.
+        """
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is None:
+            # Never started: do the final upload here if there is anything to ship
+            if self._pending:
+                self._pending = 0
+                return self.backup()
+            return True
+        thread.join(timeout)
+        with self._cond:
+            if not thread.is_alive():
+                self._thread = None
+            return not thread.is_alive()
+
+    def stats(self) -> Dict[str, object]:
+        with self._cond:
+            return {
+                "queue_depth": self._pending,
+                "pending_since": self._first_request,
+                "uploading": self._running,
+                "uploads": self.uploads,
+                "failures": self.failures,
+                "coalesced_writes": self.coalesced,
+                "last_success": self.last_success,
+                "last_failure": self.last_failure,
+                "debounce_seconds": self.debounce,
+                "max_staleness_seconds": self.max_staleness,
+            }
+
+
+BACKUP_SCHEDULER = BackupScheduler()
+# The data layer signals once a bill write has committed, so an upload can
+# never start before the write it was requested for is in the database
+on_write_committed(BACKUP_SCHEDULER.request_backup)
+
+
+# 3. The FastAPI Dependency (The Queuer)
+def queue_backup_on_write():
     """
-    FastAPI dependency function that queues the backup task.
+    FastAPI dependency for routes that write. The backup itself is requested
+    by the data layer after the write commits (see on_write_committed above);
+    this refuses the write while a Drive restore is replacing the database.
     """
-    print("🔔 Triggering non-blocking backup...")
-    # Add the execution function to the queue
-    background_tasks.add_task(_perform_background_backup)
-    
+    if DRIVE_RESTORE.running():
+        raise HTTPException(status_code=503, detail="Database restore in progress, try again shortly",
+                            headers={"Retry-After": "10"})
+
     # The dependency returns None, fulfilling the Dependency Injection requirement
     return None
 
-# 3. Create the reusable dependency object
+# 4. Create the reusable dependency object
 BackupOnWrite = Depends(queue_backup_on_write)
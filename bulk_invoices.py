@@ -0,0 +1,144 @@
+import io
+import sys
+import zipfile
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import jinja2
+from markupsafe import Markup
+
+from database_utils import stream_connection
+
+# Monthly invoice run: every user with unpaid bills, read in one ordered pass
+# and rendered with the same invoice_body.html the per-user invoice page uses.
+TEMPLATE_DIR = "app/templates"
+# Users per process-pool task; keeps pickling overhead small per invoice
+INVOICE_CHUNK_SIZE = 50
+
+# Walks idx_bills_paid_user_period in order, so rows arrive grouped by user
+SQL_UNPAID_FOR_INVOICES = """
+    SELECT user_id, device_id, user_name, user_address, pay_period,
+           meter_past, meter_now, usage, lv1_cost, lv2_cost, lv3_cost, lv4_cost,
+           basic_cost, bill_amount
+    FROM bills
+    WHERE paid = 0
+    ORDER BY user_id, pay_period DESC, id DESC
+"""
+
+_environment: Optional[jinja2.Environment] = None
+
+
+def _templates() -> jinja2.Environment:
+    # Built per process: pool workers cannot share the app's Jinja2Templates
+    global _environment
+    if _environment is None:
+        _environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+    return _environment
+
+
+def iter_unpaid_by_user(conn) -> Iterator[Tuple[str, List[Dict]]]:
+    """Yield (user_id, unpaid bill dicts) for every user with something due."""
+    rows = (dict(row) for row in conn.execute(SQL_UNPAID_FOR_INVOICES))
+    for user_id, bills in itertools.groupby(rows, key=lambda row: row["user_id"]):
+        yield user_id, list(bills)
+
+
+def render_invoice(user_id: str, bills: List[Dict], standalone: bool = False) -> str:
+    """One user's invoice: the full invoice.html page, or just its body for a combined document."""
+    template = "invoice.html" if standalone else "invoice_body.html"
+    return _templates().get_template(template).render(
+        user_id=user_id,
+        user_data=bills,
+        total_unpaid=sum(bill["bill_amount"] or 0 for bill in bills),
+    )
+
+
+def _render_chunk(chunk: List[Tuple[str, List[Dict]]], standalone: bool) -> List[Tuple[str, str]]:
+    return [(user_id, render_invoice(user_id, bills, standalone)) for user_id, bills in chunk]
+
+
+def iter_rendered_invoices(standalone: bool = False, workers: int = 0) -> Iterator[Tuple[str, str]]:
+    """Yield (user_id, html) in user_id order.
+
+    With ``workers`` > 1, chunks of users render in a process pool; at most
+    two chunks per worker are in flight, so memory stays bounded however
+    many households there are. The rows are read on a stream_connection():
+    a download to a slow client can take minutes and must not hold a pool slot.
+    """
+    with stream_connection() as conn:
+        groups = iter_unpaid_by_user(conn)
+        if workers <= 1:
+            for user_id, bills in groups:
+                yield user_id, render_invoice(user_id, bills, standalone)
+            return
+
+        chunks = iter(lambda: list(itertools.islice(groups, INVOICE_CHUNK_SIZE)), [])
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_render_chunk, chunk, standalone))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+
+def iter_invoice_document(workers: int = 0) -> Iterator[str]:
+    """All invoices as one HTML document, one customer per printed A4 page."""
+    invoices = (Markup(html) for _, html in iter_rendered_invoices(workers=workers))
+    return _templates().get_template("invoices_bulk.html").generate(invoices=invoices)
+
+
+class _ZipChunks(io.RawIOBase):
+    """Write-only sink for ZipFile; collects bytes until the stream drains them."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_invoice_zip(workers: int = 0) -> Iterator[bytes]:
+    """A ZIP with one standalone invoice_<user_id>.html per user, streamed as it is built."""
+    sink = _ZipChunks()
+    # An unseekable sink makes ZipFile write data descriptors, so nothing is rewound
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for user_id, html in iter_rendered_invoices(standalone=True, workers=workers):
+            archive.writestr(f"invoice_{user_id}.html", html)
+            yield sink.drain()
+    yield sink.drain()
+
+
+if __name__ == "__main__":
+    # e.g. `python bulk_invoices.py -o invoices.html --workers 4`
+    parser = argparse.ArgumentParser(description="Render invoices for every user with unpaid bills.")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("--zip", action="store_true", help="one HTML file per user in a ZIP archive")
+    parser.add_argument("--workers", type=int, default=0, help="render in a process pool of this size")
+    args = parser.parse_args()
+
+    if args.zip:
+        chunks = iter_invoice_zip(args.workers)
+    else:
+        chunks = (text.encode("utf-8") for text in iter_invoice_document(args.workers))
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
@@ -1,79 +1,360 @@
 import os
 import sqlite3
+import asyncio
+import functools
 import shutil
+import tempfile
 import glob
 import csv
+import codecs
+import json
+import re
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional, List, Dict
-import uuid
+
+from response_cache import bump_data_version, data_version
+from receipt_cache import RECEIPT_CACHE
+from backup_archive import archive_snapshot, latest_valid_backup, decompress_file
+from single_flight import SingleFlight
 
 DB_PATH = "app/db/bills.db"
 BACKUP_DIR = "backups"
 
+# === Connection pool settings ===
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# How long a request waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+# Threads rendering streamed responses; each stream reads on its own connection
+DB_STREAM_WORKERS = int(os.getenv("DB_STREAM_WORKERS", "4"))
+DB_BUSY_TIMEOUT_MS = 5000
+
+# Applied once per pooled connection when it is opened
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY",
+)
+
 def ensure_backup_folder():
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
-def ensure_payment_timestamp_column():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# === Schema migrations ===
+# Each entry upgrades the schema by one step; PRAGMA user_version records how
+# many have been applied, so a database only ever runs the ones it is missing.
+def _migrate_base_schema(conn):
+    """bills table with payment_timestamp and receipt_no columns"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bills (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            device_id TEXT,
+            user_name TEXT,
+            user_address TEXT,
+            pay_period TEXT,
+            meter_past INTEGER,
+            meter_now INTEGER,
+            usage INTEGER,
+            lv1_cost REAL,
+            lv2_cost REAL,
+            lv3_cost REAL,
+            lv4_cost REAL,
+            basic_cost REAL,
+            bill_amount REAL,
+            paid INTEGER DEFAULT 0
+        )
+    """)
 
-    # Check if payment_timestamp column exists
-    cursor.execute("PRAGMA table_info(bills)")
-    columns = [col["name"] for col in cursor.fetchall()]
+    # Older databases predate these columns
+    columns = [col["name"] for col in conn.execute("PRAGMA table_info(bills)")]
     if "payment_timestamp" not in columns:
-        cursor.execute("ALTER TABLE bills ADD COLUMN payment_timestamp TEXT")
-        conn.commit()
-        print("🛠️ Added 'payment_timestamp' column to bills table.")
+        conn.execute("ALTER TABLE bills ADD COLUMN payment_timestamp TEXT")
+    if "receipt_no" not in columns:
+        conn.execute("ALTER TABLE bills ADD COLUMN receipt_no TEXT")
 
-    conn.close()
 
-def ensure_receipt_no_column_exists():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _migrate_bill_indexes(conn):
+    """indexes on (user_id, pay_period), (paid, user_id) and payment date"""
+    # A bill is identified by (user_id, pay_period). Older imports could store
+    # the same bill twice; keep the paid (else oldest) copy and park the rest
+    # in bills_duplicates so the unique index can be built without losing data.
+    conn.execute("""
+        CREATE TEMP TABLE duplicate_bill_ids AS
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY user_id, pay_period ORDER BY paid DESC, id
+            ) AS copy_no
+            FROM bills
+        ) WHERE copy_no > 1
+    """)
+    duplicates = conn.execute("SELECT COUNT(*) FROM duplicate_bill_ids").fetchone()[0]
+    if duplicates:
+        conn.execute("CREATE TABLE IF NOT EXISTS bills_duplicates AS SELECT * FROM bills WHERE 0")
+        conn.execute("INSERT INTO bills_duplicates SELECT * FROM bills WHERE id IN (SELECT id FROM duplicate_bill_ids)")
+        conn.execute("DELETE FROM bills WHERE id IN (SELECT id FROM duplicate_bill_ids)")
+        print(f"⚠️ Moved {duplicates} duplicate bills to bills_duplicates.")
+    conn.execute("DROP TABLE duplicate_bill_ids")
 
-    # Check if 'receipt_no' column already exists
-    cursor.execute("PRAGMA table_info(bills);")
-    columns = [row[1] for row in cursor.fetchall()]
-    
-    if 'receipt_no' not in columns:
-        cursor.execute("ALTER TABLE bills ADD COLUMN receipt_no TEXT;")
-        conn.commit()
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bills_user_period ON bills(user_id, pay_period)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bills_paid_user ON bills(paid, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bills_paid_date ON bills(paid, DATE(payment_timestamp))")
+
+
+def _migrate_receipt_sequence(conn):
+    """per-day receipt number sequence"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS receipt_sequence (
+            day TEXT PRIMARY KEY,
+            last_no INTEGER NOT NULL
+        )
+    """)
+
+
+# Adds/removes one bill's contribution to its owner's unpaid balance
+_BALANCE_ADD = """
+    INSERT INTO user_balances (user_id, user_name, unpaid_total, unpaid_count)
+    SELECT IFNULL(NEW.user_id, ''), NEW.user_name, IFNULL(NEW.bill_amount, 0), 1 WHERE NEW.paid = 0
+    ON CONFLICT(user_id) DO UPDATE SET
+        user_name = excluded.user_name,
+        unpaid_total = unpaid_total + excluded.unpaid_total,
+        unpaid_count = unpaid_count + 1;
+"""
+_BALANCE_REMOVE = """
+    UPDATE user_balances
+    SET unpaid_total = unpaid_total - IFNULL(OLD.bill_amount, 0), unpaid_count = unpaid_count - 1
+    WHERE OLD.paid = 0 AND user_id = IFNULL(OLD.user_id, '');
+    DELETE FROM user_balances WHERE user_id = IFNULL(OLD.user_id, '') AND unpaid_count <= 0;
+"""
+
+
+def _migrate_user_balances(conn):
+    """trigger-maintained user_balances summary table"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_balances (
+            user_id TEXT PRIMARY KEY NOT NULL,
+            user_name TEXT,
+            unpaid_total REAL NOT NULL DEFAULT 0,
+            unpaid_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_balance_insert AFTER INSERT ON bills
+        BEGIN {_BALANCE_ADD} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_balance_delete AFTER DELETE ON bills
+        BEGIN {_BALANCE_REMOVE} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_balance_update
+        AFTER UPDATE OF paid, bill_amount, user_id, user_name ON bills
+        BEGIN {_BALANCE_REMOVE} {_BALANCE_ADD} END
+    """)
+    _rebuild_user_balances(conn)
+
+
+def _migrate_import_jobs(conn):
+    """import_jobs table for background CSV imports"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            spool_path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            processed INTEGER NOT NULL DEFAULT 0,
+            inserted INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            error_message TEXT,
+            resumed_from INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+    """)
+
+
+def _migrate_import_job_tariff_check(conn):
+    """tariff_mismatches counter on import_jobs"""
+    conn.execute("ALTER TABLE import_jobs ADD COLUMN tariff_mismatches INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_import_job_mismatch_rows(conn):
+    """tariff_mismatch_rows (JSON list of the first flagged rows) on import_jobs"""
+    conn.execute("ALTER TABLE import_jobs ADD COLUMN tariff_mismatch_rows TEXT")
+
+
+def _migrate_bill_page_indexes(conn):
+    """indexes matching the paginated bill listing order"""
+    # Same order as SQL_BILLS_PAGE so a page is an index range, not a sort.
+    # The paid variant supersedes idx_bills_paid_user (same leading columns).
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bills_user_period_desc ON bills(user_id, pay_period DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bills_paid_user_period ON bills(paid, user_id, pay_period DESC, id DESC)")
+    conn.execute("DROP INDEX IF EXISTS idx_bills_paid_user")
+
+
+def _migrate_bill_search(conn):
+    """trigram full-text index over user_id, user_name and device_id"""
+    # External-content FTS5 table: the text stays in bills, the triggers keep
+    # the index in step with every insert, delete and edit of those columns
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS bills_search USING fts5(
+            user_id, user_name, device_id,
+            content='bills', content_rowid='id', tokenize='trigram'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_search_insert AFTER INSERT ON bills BEGIN
+            INSERT INTO bills_search (rowid, user_id, user_name, device_id)
+            VALUES (NEW.id, NEW.user_id, NEW.user_name, NEW.device_id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_search_delete AFTER DELETE ON bills BEGIN
+            INSERT INTO bills_search (bills_search, rowid, user_id, user_name, device_id)
+            VALUES ('delete', OLD.id, OLD.user_id, OLD.user_name, OLD.device_id);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_bills_search_update
+        AFTER UPDATE OF user_id, user_name, device_id ON bills BEGIN
+            INSERT INTO bills_search (bills_search, rowid, user_id, user_name, device_id)
+            VALUES ('delete', OLD.id, OLD.user_id, OLD.user_name, OLD.device_id);
+            INSERT INTO bills_search (rowid, user_id, user_name, device_id)
+            VALUES (NEW.id, NEW.user_id, NEW.user_name, NEW.device_id);
+        END
+    """)
+    conn.execute("INSERT INTO bills_search (bills_search) VALUES ('rebuild')")
+
+
+SCHEMA_MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_bill_indexes,
+    _migrate_receipt_sequence,
+    _migrate_user_balances,
+    _migrate_import_jobs,
+    _migrate_import_job_tariff_check,
+    _migrate_bill_page_indexes,
+    _migrate_bill_search,
+    _migrate_import_job_mismatch_rows,
+]
+
+
+def migrate_db():
+    """Bring the database at DB_PATH up to the latest schema version."""
+    with db_connection() as conn:
+        for target_version, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+            # Take the write lock before checking so concurrent workers apply each step once
+            conn.execute("BEGIN IMMEDIATE")
+            current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current_version >= target_version:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+            print(f"🛠️ Applied schema migration {target_version}: {migration.__doc__}")
+
+
+def reserve_receipt_numbers(conn, count: int, now: datetime) -> List[str]:
+    """Reserve ``count`` consecutive receipt numbers for today's sequence.
+
+    Must run inside the caller's write transaction so no two payment batches
+    can be handed the same numbers.
+    """
+    if count <= 0:
+        return []
+    day = now.strftime('%Y%m%d')
+    conn.execute("""
+        INSERT INTO receipt_sequence (day, last_no) VALUES (?, ?)
+        ON CONFLICT(day) DO UPDATE SET last_no = last_no + excluded.last_no
+    """, (day, count))
+    last_no = conn.execute("SELECT last_no FROM receipt_sequence WHERE day = ?", (day,)).fetchone()[0]
+    return [f"RCP-{day}-{n:04d}" for n in range(last_no - count + 1, last_no + 1)]
+
+
+# Called with no arguments after each committed bill write; the Drive
+# backup scheduler registers itself here (see backup_dependency.py)
+_write_listeners = []
+
+
+def on_write_committed(callback):
+    _write_listeners.append(callback)
 
-    conn.close()
 
+def _write_committed(user_ids):
+    bump_data_version(user_ids)
+    for callback in _write_listeners:
+        callback()
 
 
-def generate_receipt_no(bill_id):
+def _split_by_status(conn, bill_ids: list[int], paid: int):
+    """Return (requested ids in order without repeats, the subset currently at
+    ``paid``, the user_ids owning that subset)."""
+    requested = list(dict.fromkeys(int(bill_id) for bill_id in bill_ids))
+    rows = conn.execute(
+        "SELECT id, user_id FROM bills WHERE paid = ? AND id IN (SELECT value FROM json_each(?)) ORDER BY id",
+        (paid, json.dumps(requested))
+    ).fetchall()
+    return requested, [row[0] for row in rows], {row[1] for row in rows}
+
+
+def mark_bills_as_paid(bill_ids: list[int]) -> Dict[str, List[int]]:
+    """Mark the unpaid bills among ``bill_ids`` as paid in one write transaction.
+
+    Returns ``{"paid": [...], "skipped": [...]}``; skipped ids were already
+    paid or do not exist.
+    """
     now = datetime.now()
-    return f"RCP-{now.strftime('%Y%m%d')}-{bill_id}-{uuid.uuid4().hex[:4]}"
-    
-def mark_bills_as_paid(bill_ids: list[int]):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    for bill_id in bill_ids:
-        cursor.execute("SELECT paid, receipt_no FROM bills WHERE id = ?", (bill_id,))
-        row = cursor.fetchone()
-        if row and not row['paid']:  # Only update unpaid bills
-            receipt_no = generate_receipt_no(bill_id)
-            cursor.execute("""
-                UPDATE bills 
-                SET paid = 1, payment_timestamp = ?, receipt_no = ?
-                WHERE id = ?
-            """, (now, receipt_no, bill_id))
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        requested, unpaid, user_ids = _split_by_status(conn, bill_ids, paid=0)
+        receipt_nos = reserve_receipt_numbers(conn, len(unpaid), now)
+        conn.executemany("""
+            UPDATE bills 
+            SET paid = 1, payment_timestamp = ?, receipt_no = ?
+            WHERE id = ?
+        """, [(timestamp, receipt_no, bill_id) for bill_id, receipt_no in zip(unpaid, receipt_nos)])
 
-    conn.commit()
-    conn.close()
+    if unpaid:
+        _write_committed(user_ids)
+    paid_set = set(unpaid)
+    skipped = [bill_id for bill_id in requested if bill_id not in paid_set]
+    print(f"✅ Marked {len(unpaid)} bills as paid ({len(skipped)} skipped).")
+    return {"paid": unpaid, "skipped": skipped}
 
 
-def cancel_bills_payment(bill_ids_cancel: list[int]):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.executemany("UPDATE bills SET paid = 0, payment_timestamp = NULL, receipt_no = NULL WHERE id = ?", [(bill_id,) for bill_id in bill_ids_cancel])
-    conn.commit()
-    conn.close()
+def cancel_bills_payment(bill_ids_cancel: list[int]) -> Dict[str, List[int]]:
+    """Revert the paid bills among ``bill_ids_cancel`` to unpaid in one write transaction.
 
+    Returns ``{"cancelled": [...], "skipped": [...]}``; skipped ids were not
+    paid or do not exist.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        requested, paid, user_ids = _split_by_status(conn, bill_ids_cancel, paid=1)
+        conn.executemany(
+            "UPDATE bills SET paid = 0, payment_timestamp = NULL, receipt_no = NULL WHERE id = ?",
+            [(bill_id,) for bill_id in paid]
+        )
+
+    if paid:
+        _write_committed(user_ids)
+    RECEIPT_CACHE.evict_bills(paid)
+    cancelled_set = set(paid)
+    skipped = [bill_id for bill_id in requested if bill_id not in cancelled_set]
+    print(f"↩️ Cancelled {len(paid)} payments ({len(skipped)} skipped).")
+    return {"cancelled": paid, "skipped": skipped}
 
 
 def backup_db():
@@ -85,108 +366,1047 @@ def backup_db():
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    backup_filename = f"bills_backup_{timestamp}.db"
-    backup_path = os.path.join(BACKUP_DIR, backup_filename)
+    # Compressed, catalogued (checksum, size, row count) and pruned to the retention tiers
+    with db_snapshot() as snapshot_path:
+        rows = count_bills(snapshot_path)
+        entry = archive_snapshot(snapshot_path, BACKUP_DIR, f"bills_backup_{timestamp}", rows)
+    print(f"✅ Backup created at: {os.path.join(BACKUP_DIR, entry['name'])} ({entry['size']} bytes, {rows} bills)")
 
-    shutil.copy2(DB_PATH, backup_path)
-    print(f"✅ Backup created at: {backup_path}")
 
+def count_bills(db_file: str) -> int:
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM bills").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
 
-def restore_db():
+
+# === Online snapshots ===
+# Copied with SQLite's backup API rather than as a file: the copy is one
+# consistent state, includes commits still in the WAL, and is taken in short
+# steps so writers get in between them.
+SNAPSHOT_PAGES_PER_STEP = int(os.getenv("SNAPSHOT_PAGES_PER_STEP", "4096"))
+SNAPSHOT_STEP_SLEEP = 0.005
+
+
+def snapshot_db(dest_path: str, source_path: Optional[str] = None) -> str:
+    """Write a consistent, integrity-checked copy of ``source_path`` (DB_PATH) to ``dest_path``.
+
+    The copy is built in a temp file beside ``dest_path`` and renamed into
+    place only once it is complete and passes PRAGMA quick_check.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=".snapshot-", suffix=".db", dir=os.path.dirname(dest_path) or ".")
+    os.close(fd)
+    try:
+        source = sqlite3.connect(source_path or DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        target = sqlite3.connect(tmp_path)
+        try:
+            # Pin one WAL snapshot for the whole copy. Without an open read
+            # transaction, any commit between steps restarts the backup, and
+            # steady payments would keep it from ever finishing.
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+            source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP, sleep=SNAPSHOT_STEP_SLEEP)
+            source.rollback()
+            # A standalone file: no -wal/-shm companions to ship alongside it
+            target.execute("PRAGMA journal_mode = DELETE")
+            result = target.execute("PRAGMA quick_check").fetchone()[0]
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"snapshot failed quick_check: {result}")
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return dest_path
+
+
+def benchmark_snapshot(rows: int = 2000000, write_interval: float = 0.01) -> Dict:
+    """Time the old checkpoint + shutil.copy2 backup against snapshot_db().
+
+    Builds a throwaway database of ``rows`` bill-sized rows in a temp
+    directory and keeps a writer committing every ``write_interval`` seconds
+    during each copy, as payments would. Also reports whether each copy
+    passes quick_check: copy2 may catch the file mid-write.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        source_path = os.path.join(workdir, "bench.db")
+        conn = sqlite3.connect(source_path)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE bills (id INTEGER PRIMARY KEY, user_id TEXT, user_name TEXT, "
+                     "pay_period TEXT, bill_amount REAL, paid INTEGER DEFAULT 0)")
+        conn.executemany(
+            "INSERT INTO bills (user_id, user_name, pay_period, bill_amount) VALUES (?, ?, ?, ?)",
+            ((f"u{i % 20000}", f"Pelanggan {i % 20000}", f"P{i // 20000}", 15000 + i % 30 * 1000) for i in range(rows)),
+        )
+        conn.commit()
+        conn.close()
+
+        def timed_under_writes(copy, dest_path: str) -> Dict[str, float]:
+            stop = threading.Event()
+            writes = [0]
+
+            def writer():
+                conn = sqlite3.connect(source_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+                try:
+                    while not stop.is_set():
+                        conn.execute("UPDATE bills SET paid = 1 - paid WHERE id = ?", (writes[0] % rows + 1,))
+                        conn.commit()
+                        writes[0] += 1
+                        time.sleep(write_interval)
+                finally:
+                    conn.close()
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            start = time.perf_counter()
+            try:
+                copy(dest_path)
+            finally:
+                elapsed = time.perf_counter() - start
+                stop.set()
+                thread.join()
+            check = sqlite3.connect(dest_path)
+            try:
+                intact = check.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+            except sqlite3.DatabaseError:
+                intact = False
+            finally:
+                check.close()
+            return {"seconds": round(elapsed, 3), "writes_during": writes[0], "intact": intact}
+
+        def checkpoint_and_copy(dest_path: str):
+            conn = sqlite3.connect(source_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+            try:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                conn.close()
+            shutil.copy2(source_path, dest_path)
+
+        return {
+            "rows": rows,
+            "megabytes": round(os.path.getsize(source_path) / 1e6, 1),
+            "copy2": timed_under_writes(checkpoint_and_copy, os.path.join(workdir, "copy2.db")),
+            "snapshot": timed_under_writes(lambda dest: snapshot_db(dest, source_path),
+                                           os.path.join(workdir, "snapshot.db")),
+        }
+
+
+@contextmanager
+def db_snapshot():
+    """Yield the path of a fresh snapshot in BACKUP_DIR; the file is removed afterwards."""
     ensure_backup_folder()
+    fd, path = tempfile.mkstemp(prefix=".upload-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        yield snapshot_db(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
 
-    # Get sorted list of backup files from relative BACKUP_DIR
-    backups = sorted(
-        glob.glob(os.path.join(BACKUP_DIR, "bills_backup_*.db")),
-        reverse=True
-    )
 
-    # Restore the most recent backup if available
-    if backups:
-        latest_backup = backups[0]
-        shutil.copyfile(latest_backup, DB_PATH)
-        print(f"✅ Database restored from: {latest_backup}")
-    else:
-        print("⚠️ No backups found. Starting with a fresh database.")
+def restore_db():
+    ensure_backup_folder()
 
-    # Ensure the table structure is present (fresh DB or restored one)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS bills (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            device_id TEXT,
-            user_name TEXT,
-            user_address TEXT,
-            pay_period TEXT,
-            meter_past INTEGER,
-            meter_now INTEGER,
-            usage INTEGER,
-            lv1_cost REAL,
-            lv2_cost REAL,
-            lv3_cost REAL,
-            lv4_cost REAL,
-            basic_cost REAL,
-            bill_amount REAL,
-            paid INTEGER DEFAULT 0
+    # The catalog names the newest backup that still matches its checksum
+    entry = latest_valid_backup(BACKUP_DIR)
+    if entry:
+        latest_backup = os.path.join(BACKUP_DIR, entry["name"])
+        restored_path = DB_PATH + ".restore"
+        decompress_file(latest_backup, restored_path, entry["codec"])
+        replace_db(restored_path)
+        print(f"✅ Database restored from: {latest_backup} ({entry['rows']} bills)")
+    else:
+        # Uncompressed backups from before the catalog existed
+        backups = sorted(
+            glob.glob(os.path.join(BACKUP_DIR, "bills_backup_*.db")),
+            reverse=True
         )
+        if backups:
+            latest_backup = backups[0]
+            restored_path = DB_PATH + ".restore"
+            shutil.copyfile(latest_backup, restored_path)
+            replace_db(restored_path)
+            print(f"✅ Database restored from: {latest_backup}")
+        else:
+            print("⚠️ No backups found. Starting with a fresh database.")
+            # Nothing swapped in, but the schema still has to be current
+            finish_restore()
+
+
+def replace_db(new_path: str):
+    """Move ``new_path`` over DB_PATH and finish_restore() it, with no database work in between.
+
+    Shared by restore_db() and the Drive restores.
+    """
+    with SWAP_GATE.exclusive():
+        # Pooled connections must not keep pointing at the file being replaced
+        close_db_pool()
+        os.replace(new_path, DB_PATH)
+        finish_restore()
+
+
+def finish_restore():
+    """Bring a database just swapped in at DB_PATH up to date and drop what was cached from the old one."""
+    migrate_db()
+    verify_user_balances()
+    warn_on_table_scans()
+    bump_data_version()
+    RECEIPT_CACHE.clear()
+
+
+# === Unpaid balance summary ===
+_SQL_RECOMPUTE_BALANCES = """
+    SELECT IFNULL(user_id, '') AS user_id, user_name,
+           SUM(IFNULL(bill_amount, 0)) AS unpaid_total, COUNT(*) AS unpaid_count
+    FROM bills
+    WHERE paid = 0
+    GROUP BY IFNULL(user_id, '')
+"""
+
+
+def _rebuild_user_balances(conn):
+    conn.execute("DELETE FROM user_balances")
+    conn.execute(f"""
+        INSERT INTO user_balances (user_id, user_name, unpaid_total, unpaid_count)
+        {_SQL_RECOMPUTE_BALANCES}
     """)
 
-    ensure_payment_timestamp_column()
-    ensure_receipt_no_column_exists()
-    
-    conn.commit()
-    conn.close()
+
+def verify_user_balances(rebuild: bool = True) -> List[str]:
+    """Compare user_balances with a full recompute from bills.
+
+    Returns the user_ids whose stored totals disagree; when ``rebuild`` is set
+    and any disagree, the summary table is rebuilt from scratch.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        expected = {
+            row["user_id"]: (row["unpaid_total"], row["unpaid_count"])
+            for row in conn.execute(_SQL_RECOMPUTE_BALANCES)
+        }
+        stored = {
+            row["user_id"]: (row["unpaid_total"], row["unpaid_count"])
+            for row in conn.execute("SELECT user_id, unpaid_total, unpaid_count FROM user_balances")
+        }
+        mismatched = sorted(
+            user_id for user_id in expected.keys() | stored.keys()
+            if user_id not in expected or user_id not in stored
+            or expected[user_id][1] != stored[user_id][1]
+            # Running REAL sums drift by float rounding; amounts are whole rupiah
+            or abs(expected[user_id][0] - stored[user_id][0]) > 0.005
+        )
+        if mismatched and rebuild:
+            _rebuild_user_balances(conn)
+
+    if mismatched and rebuild:
+        bump_data_version()
+    if mismatched:
+        print(f"⚠️ user_balances disagreed for {len(mismatched)} users{' - rebuilt' if rebuild else ''}.")
+    else:
+        print("✅ user_balances matches bills.")
+    return mismatched
+
+
+# === Connection pool ===
+# Async routes hand blocking SQLite work to this bounded pool instead of
+# running it on the event loop; one thread per pooled connection.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="sqlite")
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper on DB_EXECUTOR and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+# Read helpers only: writes must never be merged with one another
+DB_FLIGHTS = SingleFlight()
+
+
+async def run_db_shared(func, *args):
+    """run_db() for read helpers; concurrent calls with the same arguments share one query.
+
+    Calls made after a write has committed start a fresh query rather than
+    joining one that may have read the rows before it.
+    """
+    key = (func.__name__, *args, data_version())
+    result, _ = await DB_FLIGHTS.do(key, functools.partial(run_db, func, *args))
+    return result
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Streamed responses are drained here, never on DB_EXECUTOR: a stream sits
+# between chunks for as long as its client takes to read them
+STREAM_EXECUTOR = ThreadPoolExecutor(max_workers=DB_STREAM_WORKERS, thread_name_prefix="sqlite-stream")
+
+
+async def iterate_db(iterator):
+    """Drain a blocking generator on STREAM_EXECUTOR, one item at a time.
+
+    The generator must read through stream_connection(), not the pool.
+    """
+    exhausted = object()
+    future = None
+    try:
+        while True:
+            future = STREAM_EXECUTOR.submit(next, iterator, exhausted)
+            item = await asyncio.wrap_future(future)
+            if item is exhausted:
+                break
+            yield item
+    finally:
+        # Not awaited: on client disconnect this task is being cancelled. A
+        # next() still running closes the generator when it returns; otherwise
+        # it is closed on a stream thread, which never waits for the pool
+        if future is not None and not future.done():
+            future.add_done_callback(lambda _: iterator.close())
+        else:
+            STREAM_EXECUTOR.submit(iterator.close)
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that remembers which pool generation opened it."""
+    generation = 0
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """No pooled connection became free within DB_POOL_TIMEOUT_SECONDS."""
+
+
+def open_connection(db_path: str) -> PooledConnection:
+    conn = sqlite3.connect(
+        db_path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,  # Connections move between worker threads
+        factory=PooledConnection,
+    )
     conn.row_factory = sqlite3.Row  # Enables dict-like access in templates
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared by worker threads.
+
+    At most ``size`` connections exist at once; a thread that finds the pool
+    exhausted waits until another request hands its connection back.
+    """
+
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT_SECONDS):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def _open(self) -> PooledConnection:
+        conn = open_connection(self.db_path)
+        conn.generation = self._generation
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"no database connection free after {self.timeout:g}s ({self.size} in use)")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if conn.generation == self._generation:
+                    return conn
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: PooledConnection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                stale = conn.generation != self._generation
+                if not stale:
+                    self._idle.put(conn)
+            if stale:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """Close idle connections and retire any that are currently borrowed."""
+        with self._lock:
+            self._generation += 1
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+class SwapGate:
+    """Keeps database work and a swap of the file at DB_PATH apart.
+
+    Every db_connection() holds the gate shared for as long as it has its
+    connection; replace_db() takes it exclusively. A swap waits for borrowed
+    connections to come back and, while it runs, new borrowers wait (up to
+    DB_POOL_TIMEOUT_SECONDS, then PoolTimeout). So an in-flight write commits
+    to the old file before it is checkpointed and replaced, and no write
+    lands in the new one before it has been migrated. The swapping thread
+    itself, and threads already holding the gate, pass straight through.
+    """
+
+    def __init__(self, timeout: float = DB_POOL_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._state = threading.Condition()
+        self._holders = 0
+        self._swapper = None
+        self._local = threading.local()
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self._local, "depth", 0)
+        counted = depth == 0 and self._swapper != threading.get_ident()
+        if counted:
+            with self._state:
+                if not self._state.wait_for(lambda: self._swapper is None, self.timeout):
+                    raise PoolTimeout(f"database still being restored after {self.timeout:g}s")
+                self._holders += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if counted:
+                with self._state:
+                    self._holders -= 1
+                    self._state.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._state:
+            self._state.wait_for(lambda: self._swapper is None)
+            # From here new borrowers wait; then let the current ones finish
+            self._swapper = threading.get_ident()
+            self._state.wait_for(lambda: self._holders == 0)
+        try:
+            yield
+        finally:
+            with self._state:
+                self._swapper = None
+                self._state.notify_all()
+
+
+SWAP_GATE = SwapGate()
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != DB_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; commits on success, rolls back on error.
+
+    Waits while replace_db() swaps the database file (see SwapGate).
+    """
+    with SWAP_GATE.shared():
+        pool = get_db_pool()
+        conn = pool.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            pool.release(conn)
+
+
+@contextmanager
+def stream_connection():
+    """A read-only connection of its own for a streamed response.
+
+    Streams stay open while slow clients read, so they must not hold one of
+    the pool's slots; the connection is closed when the stream ends.
+    """
+    conn = open_connection(DB_PATH)
+    try:
+        conn.execute("PRAGMA query_only = 1")
+        yield conn
+    finally:
+        conn.close()
+
+
+def get_db():
+    """FastAPI dependency wrapper around db_connection()."""
+    with db_connection() as conn:
+        yield conn
+
+
+def close_db_pool():
+    """Checkpoint and close pooled connections before DB_PATH is replaced on disk."""
+    checkpoint_db()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+    # A leftover WAL would be replayed on top of the replacement file
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+
+
+def checkpoint_db():
+    """Copy committed WAL pages back into the main database file."""
+    if not os.path.exists(DB_PATH):
+        return
+    try:
+        with db_connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.DatabaseError as e:
+        print(f"⚠️ WAL checkpoint skipped: {e}")
+
+
 def insert_from_csv(file_path: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows_inserted = 0
-        for row in reader:
-            cursor.execute("""
-                INSERT INTO bills (
-                    user_id, device_id, user_name, user_address,
-                    pay_period, meter_past, meter_now, usage,
-                    lv1_cost, lv2_cost, lv3_cost, lv4_cost,
-                    basic_cost, bill_amount, paid
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-            """, (
-                row['user_id'], row['device_id'], row['user_name'], row['user_address'],
-                row['pay_period'], row['meter_past'], row['meter_now'], row['usage'],
-                row['lv1_cost'], row['lv2_cost'], row['lv3_cost'], row['lv4_cost'],
-                row['basic_cost'], row['bill_amount']
-            ))
-            rows_inserted += 1
-
-    conn.commit()
-    conn.close()
-    
-    ensure_payment_timestamp_column()
-    ensure_receipt_no_column_exists()
+    with open(file_path, 'rb') as csvfile:
+        counts = import_bill_rows(csv.DictReader(iter_text_lines(csvfile)))
+
     backup_db()
-    print(f"✅ Inserted {rows_inserted} rows and created backup.")
+    print(f"✅ Inserted {counts['inserted']} rows ({counts['duplicates']} duplicates, "
+          f"{counts['errors']} errors) and created backup.")
 
 
-#===payment summary====
-def get_daily_payment_summary(start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# === Hot queries ===
+# Shared with main.py so the query-plan check below covers what routes really run
+SQL_UNPAID_BY_USER = "SELECT * FROM bills WHERE user_id = ? AND paid = 0"
+# Public /user page in one statement: the unpaid bills plus the latest paid
+# one, which is only shown when nothing is due. Just the columns user.html
+# (and its ETag) needs.
+SQL_USER_BILLS = """
+    SELECT id, user_id, device_id, user_name, user_address, pay_period,
+           meter_past, meter_now, usage, lv1_cost, lv2_cost, lv3_cost, lv4_cost,
+           basic_cost, bill_amount, paid, payment_timestamp, receipt_no
+    FROM bills
+    WHERE user_id = :user_id AND (
+        paid = 0
+        OR id = (
+            SELECT id FROM bills
+            WHERE user_id = :user_id AND paid = 1
+            ORDER BY payment_timestamp DESC
+            LIMIT 1
+        )
+    )
+    ORDER BY paid, id
+"""
+SQL_UNPAID_SUMMARY = """
+    SELECT user_name, user_id, unpaid_total AS total_unpaid, unpaid_count
+    FROM user_balances
+    ORDER BY user_id
+"""
+SQL_USER_BALANCE = "SELECT unpaid_total, unpaid_count FROM user_balances WHERE user_id = ?"
+SQL_TOTAL_UNPAID = "SELECT IFNULL(SUM(unpaid_total), 0) AS total_unpaid, IFNULL(SUM(unpaid_count), 0) AS unpaid_count FROM user_balances"
+SQL_BILL_BY_ID = "SELECT * FROM bills WHERE id = ?"
+SQL_PAID_BILLS_BY_IDS = "SELECT * FROM bills WHERE paid = 1 AND id IN (SELECT value FROM json_each(?)) ORDER BY id"
+SQL_DAILY_PAYMENT_SUMMARY = """
+    SELECT DATE(payment_timestamp) as payment_date, SUM(bill_amount) as total_payment
+    FROM bills
+    WHERE paid = 1
+"""
+SQL_BILLS_BY_DATE = """
+    SELECT user_name, pay_period, bill_amount
+    FROM bills
+    WHERE paid = 1 AND DATE(payment_timestamp) = ?
+    ORDER BY user_name
+"""
+# Keyset pagination: the cursor is the (user_id, pay_period, id) of the last
+# row already shown, so every page is a bounded index range whatever the offset.
+SQL_BILLS_PAGE_AFTER = """
+    user_id >= :after_user_id AND (
+        user_id > :after_user_id
+        OR pay_period < :after_pay_period
+        OR (pay_period = :after_pay_period AND id < :after_id)
+    )
+"""
+SQL_BILLS_PAGE_ORDER = " ORDER BY user_id, pay_period DESC, id DESC LIMIT :limit"
+
+HOT_QUERIES = {
+    "unpaid_by_user": (SQL_UNPAID_BY_USER, ("0",)),
+    "user_bills": (SQL_USER_BILLS, {"user_id": "0"}),
+    "unpaid_summary": (SQL_UNPAID_SUMMARY, ()),
+    "bill_by_id": (SQL_BILL_BY_ID, (0,)),
+    "daily_payment_summary": (
+        SQL_DAILY_PAYMENT_SUMMARY
+        + " AND DATE(payment_timestamp) >= ? AND DATE(payment_timestamp) <= ?"
+        + " GROUP BY DATE(payment_timestamp) ORDER BY DATE(payment_timestamp) DESC",
+        ("2000-01-01", "2000-01-31"),
+    ),
+    "bills_by_date": (SQL_BILLS_BY_DATE, ("2000-01-01",)),
+    "bills_page": (
+        "SELECT * FROM bills WHERE paid = :paid AND" + SQL_BILLS_PAGE_AFTER + SQL_BILLS_PAGE_ORDER,
+        {"paid": 0, "after_user_id": "0", "after_pay_period": "", "after_id": 0, "limit": 1},
+    ),
+}
+
+
+def find_table_scans() -> Dict[str, List[str]]:
+    """EXPLAIN QUERY PLAN every hot query; return the ones that scan the whole bills table."""
+    scans = {}
+    with db_connection() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            plan = [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            # "SCAN bills" (or "SCAN TABLE bills" on older SQLite) means every row is visited
+            if any(detail.startswith(("SCAN bills", "SCAN TABLE bills")) for detail in plan):
+                scans[name] = plan
+    return scans
+
+
+def warn_on_table_scans():
+    for name, plan in find_table_scans().items():
+        print(f"⚠️ Hot query '{name}' falls back to a table scan: {plan}")
+
+
+# === Route data access ===
+# Blocking helpers behind the async routes in main.py; call them through run_db().
+# The stream_* helpers below take a stream_connection() held open for the
+# whole response and return lazy cursors that the template reads while rendering.
+def stream_admin_dashboard(conn):
+    # Bill rows are paged in by the dashboard through get_bills_page()
+    total_unpaid = conn.execute(SQL_TOTAL_UNPAID).fetchone()["total_unpaid"]
+    return {"summary": conn.execute(SQL_UNPAID_SUMMARY), "total": total_unpaid}
+
+
+BILLS_PAGE_SIZE = int(os.getenv("BILLS_PAGE_SIZE", "100"))
+BILLS_PAGE_MAX = 500
+
+
+def _bill_filters(paid: Optional[bool] = None, pay_period: Optional[str] = None,
+                  user_id: Optional[str] = None, device_id: Optional[str] = None,
+                  search: Optional[str] = None):
+    """WHERE conditions and named params shared by the bill page and its totals."""
+    conditions, params = [], {}
+    if paid is not None:
+        conditions.append("paid = :paid")
+        params["paid"] = int(paid)
+    if pay_period:
+        conditions.append("pay_period = :pay_period")
+        params["pay_period"] = pay_period
+    if user_id:
+        conditions.append("user_id = :user_id")
+        params["user_id"] = user_id
+    if device_id:
+        conditions.append("device_id = :device_id")
+        params["device_id"] = device_id
+    search = (search or "").strip()
+    if len(search) >= SEARCH_MIN_TRIGRAM:
+        conditions.append("id IN (SELECT rowid FROM bills_search WHERE bills_search MATCH :search)")
+        params["search"] = '"' + search.replace('"', '""') + '"'
+    elif search:
+        # Too short for trigrams: treat it as a user_id prefix
+        conditions.append("user_id >= :search AND user_id < :search || char(1114111)")
+        params["search"] = search
+    return conditions, params
+
+
+def get_bills_page(paid: Optional[bool] = None, pay_period: Optional[str] = None,
+                   user_id: Optional[str] = None, after: Optional[tuple] = None,
+                   limit: int = BILLS_PAGE_SIZE, device_id: Optional[str] = None,
+                   search: Optional[str] = None):
+    """One page of bills ordered by (user_id, pay_period DESC, id DESC).
+
+    ``after`` is the (user_id, pay_period, id) cursor of the previous page's
+    last row. ``search`` matches user_id, user_name or device_id like
+    search_bills(). Returns (rows, next_cursor); next_cursor is None on the
+    last page.
+    """
+    limit = max(1, min(limit, BILLS_PAGE_MAX))
+    conditions, params = _bill_filters(paid, pay_period, user_id, device_id, search)
+    params["limit"] = limit + 1  # One extra row tells us whether another page exists
+    if after is not None:
+        conditions.append(SQL_BILLS_PAGE_AFTER)
+        params["after_user_id"], params["after_pay_period"], params["after_id"] = after
+
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    with db_connection() as conn:
+        rows = conn.execute("SELECT * FROM bills" + where + SQL_BILLS_PAGE_ORDER, params).fetchall()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, (last["user_id"], last["pay_period"], last["id"])
+
 
-    query = """
-        SELECT DATE(payment_timestamp) as payment_date, SUM(bill_amount) as total_payment
-        FROM bills
-        WHERE paid = 1
+def get_bills_total(paid: Optional[bool] = None, pay_period: Optional[str] = None,
+                    user_id: Optional[str] = None, device_id: Optional[str] = None,
+                    search: Optional[str] = None) -> Dict[str, float]:
+    """Count and amount of every bill matching the get_bills_page() filters."""
+    conditions, params = _bill_filters(paid, pay_period, user_id, device_id, search)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) AS count, IFNULL(SUM(bill_amount), 0) AS amount FROM bills" + where, params
+        ).fetchone()
+    return {"count": row["count"], "amount": row["amount"]}
+
+
+# The cart's running total; extra bills are picked through get_bills_page()
+SQL_CART_BILLS = "SELECT * FROM bills WHERE id IN (SELECT value FROM json_each(:ids)) ORDER BY user_id, pay_period DESC"
+# Every bill in the cart, paid or not: after checkout it shows the amount just collected
+SQL_CART_TOTAL = """
+    SELECT COUNT(*) AS bill_count, IFNULL(SUM(bill_amount), 0) AS total_amount
+    FROM bills
+    WHERE id IN (SELECT value FROM json_each(:ids))
+"""
+
+
+def stream_shopping_cart(conn, receipt_id_list: List[int]):
+    ids = json.dumps(receipt_id_list)
+    return {
+        "selected_bills": conn.cursor().execute(SQL_CART_BILLS, {"ids": ids}),
+        "receipt_ids": receipt_id_list,
+        "cart_total": conn.execute(SQL_CART_TOTAL, {"ids": ids}).fetchone(),
+        "arrears": conn.execute(SQL_TOTAL_UNPAID).fetchone(),
+    }
+
+
+def get_user_bills(user_id: str):
+    """Unpaid bills for the public page, or the latest paid bill when none are due.
+
+    Returns ``(rows, all_paid)``.
+    """
+    with db_connection() as conn:
+        rows = conn.execute(SQL_USER_BILLS, {"user_id": user_id}).fetchall()
+    # Unpaid rows sort first; a trailing paid row only matters if there are none
+    if rows and not rows[0]["paid"]:
+        return [row for row in rows if not row["paid"]], False
+    return rows, True
+
+
+def get_invoice(user_id: str):
+    with db_connection() as conn:
+        user_data = conn.execute(SQL_UNPAID_BY_USER, (user_id,)).fetchall()
+        balance = conn.execute(SQL_USER_BALANCE, (user_id,)).fetchone()
+    return user_data, balance["unpaid_total"] if balance else 0
+
+
+def get_bill(bill_id: int):
+    with db_connection() as conn:
+        return conn.execute(SQL_BILL_BY_ID, (bill_id,)).fetchone()
+
+
+def get_paid_bills(bill_ids: List[int]):
+    """The paid bills among ``bill_ids`` with everything a receipt shows, in id order."""
+    with db_connection() as conn:
+        return conn.execute(SQL_PAID_BILLS_BY_IDS, (json.dumps([int(bill_id) for bill_id in bill_ids]),)).fetchall()
+
+
+# Bill search: trigram matches anywhere in user_id, user_name or device_id.
+# Candidates are the newest trigram hits plus an ID-prefix range on the
+# user_id index (so an exact ID is never crowded out); those few rows are
+# then ranked exact ID, ID prefix, name prefix, newest. bm25() is skipped on
+# purpose: scoring every hit of a common name costs hundreds of ms at 100k bills.
+SQL_SEARCH_BILLS = """
+    SELECT id, user_id, user_name, device_id, pay_period, paid
+    FROM bills
+    WHERE id IN (
+        SELECT rowid FROM (
+            SELECT rowid FROM bills_search WHERE bills_search MATCH :match
+            ORDER BY rowid DESC LIMIT :candidates
+        )
+        UNION
+        SELECT id FROM (
+            SELECT id FROM bills WHERE user_id >= :query AND user_id < :query || char(1114111)
+            ORDER BY user_id LIMIT :candidates
+        )
+    )
+    ORDER BY user_id = :query DESC,
+             user_id LIKE :prefix ESCAPE '\\' DESC,
+             user_name LIKE :prefix ESCAPE '\\' DESC,
+             id DESC
+    LIMIT :limit
+"""
+# Trigrams need three characters; shorter input only gets the ID prefix range
+SQL_SEARCH_BILLS_SHORT = """
+    SELECT id, user_id, user_name, device_id, pay_period, paid
+    FROM bills
+    WHERE user_id >= :query AND user_id < :query || char(1114111)
+    ORDER BY user_id = :query DESC, user_id, pay_period DESC
+    LIMIT :limit
+"""
+SEARCH_MIN_TRIGRAM = 3
+SEARCH_LIMIT = 20
+SEARCH_CANDIDATES = 200
+
+
+def search_bills(query: str, limit: int = SEARCH_LIMIT):
+    query = query.strip()
+    if not query:
+        return []
+    params = {"query": query, "limit": limit, "candidates": SEARCH_CANDIDATES}
+    if len(query) < SEARCH_MIN_TRIGRAM:
+        sql = SQL_SEARCH_BILLS_SHORT
+    else:
+        sql = SQL_SEARCH_BILLS
+        # Quoted as one FTS5 string so operators in user input stay literal
+        params["match"] = '"' + query.replace('"', '""') + '"'
+        params["prefix"] = re.sub(r"([\\%_])", r"\\\1", query) + "%"
+    with db_connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def _bill_owner(conn, bill_id: int) -> Optional[str]:
+    row = conn.execute("SELECT user_id FROM bills WHERE id = ?", (bill_id,)).fetchone()
+    return row[0] if row else None
+
+
+def update_bill(bill_id: int, fields: Dict):
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        previous_owner = _bill_owner(conn, bill_id)
+        conn.execute("""
+            UPDATE bills SET 
+                user_id = :user_id, device_id = :device_id, user_name = :user_name,
+                user_address = :user_address, pay_period = :pay_period,
+                meter_past = :meter_past, meter_now = :meter_now, usage = :usage,
+                lv1_cost = :lv1_cost, lv2_cost = :lv2_cost, lv3_cost = :lv3_cost, lv4_cost = :lv4_cost,
+                basic_cost = :basic_cost, bill_amount = :bill_amount, paid = :paid
+            WHERE id = :bill_id
+        """, {**fields, "bill_id": bill_id})
+    if previous_owner is not None:
+        _write_committed({previous_owner, fields["user_id"]})
+    RECEIPT_CACHE.evict_bills([bill_id])
+
+
+def delete_bill(bill_id: int):
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        owner = _bill_owner(conn, bill_id)
+        conn.execute("DELETE FROM bills WHERE id = ?", (bill_id,))
+    if owner is not None:
+        _write_committed({owner})
+    RECEIPT_CACHE.evict_bills([bill_id])
+
+
+# === CSV import ===
+# Header mapping: CSV header → expected DB column name
+CSV_TO_DB_KEYS = {
+    'lvl1_cost': 'lv1_cost',
+    'lvl2_cost': 'lv2_cost',
+    'lvl3_cost': 'lv3_cost',
+    'lvl4_cost': 'lv4_cost',
+    'user_id': 'user_id',
+    'device_id': 'device_id',
+    'user_name': 'user_name',
+    'user_address': 'user_address',
+    'pay_period': 'pay_period',
+    'meter_past': 'meter_past',
+    'meter_now': 'meter_now',
+    'usage': 'usage',
+    'basic_cost': 'basic_cost',
+    'bill_amount': 'bill_amount'
+}
+
+
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def iter_text_lines(binary_file, encoding: str = "utf-8-sig", chunk_size: int = CSV_CHUNK_SIZE):
+    """Yield decoded lines (with line endings) from a binary file, reading fixed-size chunks.
+
+    Only one chunk plus one partial line is held in memory, however large the
+    file is. utf-8-sig also strips the BOM spreadsheet exports often start with.
     """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    while True:
+        chunk = binary_file.read(chunk_size)
+        pending += decoder.decode(chunk, final=not chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+
+SQL_INSERT_BILL = """
+    INSERT INTO bills (
+        user_id, device_id, user_name, user_address, pay_period, meter_past, meter_now,
+        usage, lv1_cost, lv2_cost, lv3_cost, lv4_cost, basic_cost, bill_amount, paid
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+    ON CONFLICT (user_id, pay_period) DO NOTHING
+"""
+
+
+# === Cleaning Functions ===
+def clean_int(val):
+    val = val.replace('$', '').replace(',', '').strip()
+    return int(float(val or 0))
+
+def clean_float(val):
+    val = val.replace('$', '').replace(',', '').strip()
+    return round(float(val or 0.0), 2)
+
+# Addresses are RT numbers that spreadsheets turned into dates; only a few
+# distinct values exist, so memoising skips strptime on almost every row
+@functools.lru_cache(maxsize=4096)
+def clean_date_to_mmdd(val):
+    try:
+        dt = datetime.strptime(val.strip(), "%m/%d/%Y")
+        return dt.strftime("%m/%d")
+    except ValueError:
+        return val.strip()
+
+
+# SQL_INSERT_BILL parameter order
+BILL_IMPORT_COLUMNS = (
+    'user_id', 'device_id', 'user_name', 'user_address', 'pay_period',
+    'meter_past', 'meter_now', 'usage',
+    'lv1_cost', 'lv2_cost', 'lv3_cost', 'lv4_cost', 'basic_cost', 'bill_amount',
+)
+_DB_TO_CSV_KEYS = {db_key: csv_key for csv_key, db_key in CSV_TO_DB_KEYS.items()}
+
+
+def resolve_source_keys(fieldnames) -> List[str]:
+    """CSV header to read for each BILL_IMPORT_COLUMNS entry, resolved once per file.
+
+    Metering exports use the lvlN_cost headers; files written from the DB use lvN_cost.
+    """
+    return [
+        _DB_TO_CSV_KEYS[column] if _DB_TO_CSV_KEYS[column] in fieldnames else column
+        for column in BILL_IMPORT_COLUMNS
+    ]
+
+
+def clean_bill_row(raw_row: Dict, source_keys: List[str]) -> tuple:
+    """Remap one CSV row to DB columns and clean it into SQL_INSERT_BILL parameters."""
+    # A short row leaves None values, which fail on .strip() and count as errors
+    (user_id, device_id, user_name, user_address, pay_period,
+     meter_past, meter_now, usage,
+     lv1_cost, lv2_cost, lv3_cost, lv4_cost, basic_cost, bill_amount) = [
+        raw_row.get(key, "").strip() for key in source_keys
+    ]
+    return (
+        user_id, device_id, user_name, clean_date_to_mmdd(user_address), pay_period,
+        clean_int(meter_past), clean_int(meter_now), clean_int(usage),
+        clean_float(lv1_cost), clean_float(lv2_cost), clean_float(lv3_cost), clean_float(lv4_cost),
+        clean_float(basic_cost), clean_float(bill_amount),
+    )
+
+
+def _insert_bill_batch(conn, batch: List[tuple]) -> int:
+    cursor = conn.executemany(SQL_INSERT_BILL, batch)
+    # rowcount sums the rows actually inserted; conflicts on (user_id, pay_period) add nothing
+    return cursor.rowcount
+
+
+# Flagged rows kept per import for the job status; the count covers them all
+TARIFF_MISMATCH_ROWS_MAX = 50
+
+
+def import_bill_rows(raw_rows, batch_size: int = IMPORT_BATCH_SIZE, checkpoint=None, counts: Optional[Dict[str, int]] = None, validate_batch=None) -> Dict[str, int]:
+    """Insert the new bills from an iterable of CSV dict rows.
+
+    Rows are cleaned and written with executemany ``batch_size`` at a time;
+    bills already present (same user_id and pay_period) are skipped by the
+    unique index. Rows are consumed lazily, so a csv.DictReader over
+    iter_text_lines() keeps memory flat.
+
+    Without ``checkpoint`` everything is written in one transaction. With it,
+    each batch is committed separately and ``checkpoint(conn, counts)`` is
+    called inside that batch's transaction, so progress recorded there always
+    matches what has been committed; the write lock is then only held while
+    a batch is inserted, so payments are not kept waiting by a long import. ``counts`` continues earlier totals when
+    resuming. ``validate_batch(batch)`` may return the positions of cleaned
+    rows that look wrong (e.g. tariff.find_batch_mismatches); they are still
+    inserted but counted, and the first TARIFF_MISMATCH_ROWS_MAX of them are
+    listed in ``tariff_mismatch_rows`` by CSV row number (1 = first row after
+    the header). Returns those along with the processed, inserted,
+    duplicates, errors and tariff_mismatches counters.
+    """
+    counts = {"processed": 0, "inserted": 0, "duplicates": 0, "errors": 0, "tariff_mismatches": 0,
+              "tariff_mismatch_rows": [], **(counts or {})}
+    batch = []
+    batch_row_numbers = []  # CSV row number of each batch entry
+    pending = 0  # rows consumed since the last flush, including rejected ones
+    touched_users = set()  # whose cached /user pages the uncommitted rows affect
+
+    def flush():
+        nonlocal pending
+        if validate_batch is not None:
+            flagged = validate_batch(batch)
+            counts["tariff_mismatches"] += len(flagged)
+            for i in flagged[:TARIFF_MISMATCH_ROWS_MAX - len(counts["tariff_mismatch_rows"])]:
+                counts["tariff_mismatch_rows"].append({
+                    "row": batch_row_numbers[i], "user_id": batch[i][0], "pay_period": batch[i][4],
+                    "bill_amount": batch[i][13],
+                })
+        # The write lock is taken only now, not while the next rows are read and checked
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        inserted = _insert_bill_batch(conn, batch) if batch else 0
+        if inserted:
+            touched_users.update(row[0] for row in batch)
+        counts["processed"] += pending
+        counts["inserted"] += inserted
+        counts["duplicates"] += len(batch) - inserted
+        batch.clear()
+        batch_row_numbers.clear()
+        pending = 0
+        if checkpoint is not None:
+            checkpoint(conn, counts)
+            conn.commit()
+            if touched_users:
+                bump_data_version(touched_users)
+                touched_users.clear()
+
+    with db_connection() as conn:
+        source_keys = None
+        for raw_row in raw_rows:
+            if source_keys is None:
+                source_keys = resolve_source_keys(raw_row.keys())
+            pending += 1
+            try:
+                batch.append(clean_bill_row(raw_row, source_keys))
+                batch_row_numbers.append(counts["processed"] + pending)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"❌ Skipped row due to error: {e}")
+                counts["errors"] += 1
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+
+    if touched_users:
+        bump_data_version(touched_users)
+    return counts
+
+
+#===payment summary====
+def stream_daily_payment_summary(conn, start_date: Optional[str] = None, end_date: Optional[str] = None):
+    query = SQL_DAILY_PAYMENT_SUMMARY
     params = []
 
     if start_date:
@@ -197,23 +1417,35 @@ def get_daily_payment_summary(start_date: Optional[str] = None, end_date: Option
         params.append(end_date)
 
     query += " GROUP BY DATE(payment_timestamp) ORDER BY DATE(payment_timestamp) DESC"
-    cursor.execute(query, params)
-    result = [{"payment_date": row[0], "total_payment": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    return result
+    return {"mode": "summary", "summary": conn.execute(query, params), "start": start_date, "end": end_date}
 
 
-def get_bills_by_date(payment_date: str) -> List[Dict]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def stream_bills_by_date(conn, payment_date: str):
+    # The template sums the subtotal as the rows go by
+    return {"mode": "daily_details", "selected_date": payment_date,
+            "bills": conn.execute(SQL_BILLS_BY_DATE, (payment_date,))}
 
-    cursor.execute("""
-        SELECT user_name, pay_period, bill_amount
-        FROM bills
-        WHERE paid = 1 AND DATE(payment_timestamp) = ?
-        ORDER BY user_name
-    """, (payment_date,))
-    
-    result = [{"user_name": row[0], "pay_period": row[1], "bill_amount": row[2]} for row in cursor.fetchall()]
-    conn.close()
-    return result
+
+if __name__ == "__main__":
+    import sys
+
+    # Maintenance commands, e.g. `python database_utils.py verify-balances`
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "verify-balances":
+        migrate_db()
+        sys.exit(1 if verify_user_balances() else 0)
+    elif command == "check-plans":
+        # Fails (exit 1) when a hot query has lost its index, e.g. in CI
+        migrate_db()
+        scans = find_table_scans()
+        for name, plan in scans.items():
+            print(f"❌ Hot query '{name}' falls back to a table scan: {plan}")
+        if not scans:
+            print(f"✅ All {len(HOT_QUERIES)} hot queries use an index.")
+        sys.exit(1 if scans else 0)
+    elif command == "benchmark-snapshot":
+        # python database_utils.py benchmark-snapshot [rows]
+        print(f"⏱️ {benchmark_snapshot(*(int(arg) for arg in sys.argv[2:3]))}")
+    else:
+        print("Usage: python database_utils.py verify-balances | check-plans | benchmark-snapshot [rows]")
+        sys.exit(2)
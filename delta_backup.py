@@ -0,0 +1,367 @@
+import os
+import gzip
+import json
+import shutil
+import struct
+import hashlib
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from backup_archive import CODEC_SUFFIXES, active_codec, compress_file, decompress_file, retained
+from database_utils import DB_PATH, BACKUP_DIR, ensure_backup_folder, snapshot_db, replace_db
+
+# Page-level delta backups. A base is a full snapshot, compressed like the
+# full backups (BACKUP_CODEC); each later backup ships only the pages that
+# differ from the previous one, as a gzipped segment. A restore downloads the
+# newest base and replays its deltas in order:
+#
+#   bills_base_<base_id>.db[.gz|.zst]
+#   bills_delta_<base_id>_<seq>.bin.gz
+#
+# Retention keeps or drops a base together with all of its deltas.
+#
+# The page hashes of the last shipped state are kept locally
+# (delta_state.json + delta_pages.bin in BACKUP_DIR), so finding the changed
+# pages needs no download.
+BASE_PREFIX = "bills_base_"
+DELTA_PREFIX = "bills_delta_"
+# Start a new base after this many deltas...
+DELTA_MAX_CHAIN = int(os.getenv("DELTA_MAX_CHAIN", "48"))
+# ...or once the deltas add up to this fraction of the base size
+DELTA_REBASE_RATIO = float(os.getenv("DELTA_REBASE_RATIO", "0.5"))
+# A local directory standing in for the Drive folder (e.g. for trying this out)
+DELTA_BACKUP_DIR = os.getenv("DELTA_BACKUP_DIR")
+# Also the base's creation time, which dates its chain for retention
+BASE_ID_FORMAT = "%Y%m%d%H%M%S"
+
+STATE_PATH = os.path.join(BACKUP_DIR, "delta_state.json")
+HASHES_PATH = os.path.join(BACKUP_DIR, "delta_pages.bin")
+
+SEGMENT_MAGIC = b"BDLT"
+# magic, format version, page_size, page_count after the delta, changed pages, seq, state digest
+SEGMENT_HEADER = struct.Struct(">4sHIIII16s")
+PAGE_NO = struct.Struct(">I")
+HASH_SIZE = 16
+
+
+# === Stores ===
+class LocalDirStore:
+    """Backup files in a plain directory; same interface as DriveStore."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, local_path: str, name: str) -> bool:
+        tmp_path = os.path.join(self.directory, f".{name}.tmp")
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        return True
+
+    def list(self, prefix: str) -> List[str]:
+        return sorted(name for name in os.listdir(self.directory) if name.startswith(prefix))
+
+    def download(self, name: str, dest_path: str):
+        shutil.copyfile(os.path.join(self.directory, name), dest_path)
+
+    def delete(self, name: str):
+        os.remove(os.path.join(self.directory, name))
+
+
+class DriveStore:
+    """The shared Google Drive backup folder."""
+
+    def __init__(self):
+        # Imported here: drive_uploader needs GOOGLE_SERVICE_ACCOUNT, which
+        # LocalDirStore users may not have
+        import drive_uploader
+        self.drive = drive_uploader
+        self._ids: Dict[str, str] = {}
+
+    def upload(self, local_path: str, name: str) -> bool:
+        return self.drive.upload_to_drive(local_path, name)
+
+    def list(self, prefix: str) -> List[str]:
+        # A re-uploaded name (retry after a lost response) keeps its newest copy
+        ids = {f["name"]: f["id"] for f in self.drive.list_drive_files(prefix)}
+        self._ids.update(ids)
+        return sorted(ids)
+
+    def download(self, name: str, dest_path: str):
+        self.drive.download_from_drive(self._ids[name], dest_path)
+
+    def delete(self, name: str):
+        self.drive.delete_from_drive(self._ids.pop(name))
+
+
+def default_store():
+    return LocalDirStore(DELTA_BACKUP_DIR) if DELTA_BACKUP_DIR else DriveStore()
+
+
+def _base_id(name: str) -> str:
+    return name[len(BASE_PREFIX):].split(".", 1)[0]
+
+
+def _delta_base_id(name: str) -> str:
+    return name[len(DELTA_PREFIX):].rsplit("_", 1)[0]
+
+
+# === Page hashing ===
+def _page_size(path: str) -> int:
+    with open(path, "rb") as f:
+        header = f.read(18)
+    size = int.from_bytes(header[16:18], "big")
+    # The header stores 65536 as 1
+    return 65536 if size == 1 else size
+
+
+def _iter_pages(path: str, page_size: int):
+    with open(path, "rb") as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                return
+            yield page
+
+
+def page_hashes(path: str, page_size: int) -> bytes:
+    """One 16-byte digest per page, concatenated."""
+    return b"".join(hashlib.blake2b(page, digest_size=HASH_SIZE).digest() for page in _iter_pages(path, page_size))
+
+
+def _state_digest(hashes: bytes) -> bytes:
+    return hashlib.blake2b(hashes, digest_size=HASH_SIZE).digest()
+
+
+def _load_state() -> Optional[Tuple[Dict, bytes]]:
+    try:
+        with open(STATE_PATH) as f:
+            state = json.load(f)
+        with open(HASHES_PATH, "rb") as f:
+            hashes = f.read()
+    except (OSError, ValueError):
+        return None
+    if _state_digest(hashes).hex() != state.get("digest"):
+        return None
+    return state, hashes
+
+
+def _save_state(state: Dict, hashes: bytes):
+    ensure_backup_folder()
+    state = {**state, "digest": _state_digest(hashes).hex()}
+    for path, data, mode in ((HASHES_PATH, hashes, "wb"), (STATE_PATH, json.dumps(state), "w")):
+        with open(path + ".tmp", mode) as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+# === Segments ===
+def write_segment(snapshot_path: str, dest_path: str, page_size: int, old_hashes: bytes, new_hashes: bytes, seq: int) -> int:
+    """Write the pages whose hash changed to a gzipped segment; returns how many."""
+    changed = [
+        page_no for page_no in range(len(new_hashes) // HASH_SIZE)
+        if new_hashes[page_no * HASH_SIZE:(page_no + 1) * HASH_SIZE]
+        != old_hashes[page_no * HASH_SIZE:(page_no + 1) * HASH_SIZE]
+    ]
+    with open(snapshot_path, "rb") as src, gzip.open(dest_path, "wb", compresslevel=6) as out:
+        out.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 1, page_size, len(new_hashes) // HASH_SIZE,
+                                      len(changed), seq, _state_digest(new_hashes)))
+        for page_no in changed:
+            src.seek(page_no * page_size)
+            out.write(PAGE_NO.pack(page_no))
+            out.write(src.read(page_size))
+    return len(changed)
+
+
+def apply_segment(db_path: str, segment_path: str, expected_seq: int) -> Tuple[int, bytes]:
+    """Replay a segment onto the file at ``db_path`` in place.
+
+    Returns (page_size, digest of the state the segment leads to).
+    """
+    with gzip.open(segment_path, "rb") as seg, open(db_path, "r+b") as db:
+        magic, version, page_size, page_count, changed, seq, digest = SEGMENT_HEADER.unpack(seg.read(SEGMENT_HEADER.size))
+        if magic != SEGMENT_MAGIC or version != 1:
+            raise ValueError(f"{segment_path} is not a delta segment")
+        if seq != expected_seq:
+            raise ValueError(f"delta chain broken: expected seq {expected_seq}, found {seq}")
+        for _ in range(changed):
+            (page_no,) = PAGE_NO.unpack(seg.read(PAGE_NO.size))
+            page = seg.read(page_size)
+            if len(page) != page_size:
+                raise ValueError(f"{segment_path} is truncated")
+            db.seek(page_no * page_size)
+            db.write(page)
+        db.truncate(page_count * page_size)
+    return page_size, digest
+
+
+# === Backup ===
+def ship_delta_backup(store=None) -> bool:
+    """Ship the database as a delta against the last shipped state, or as a new base."""
+    store = store or default_store()
+    ensure_backup_folder()
+    fd, snapshot_path = tempfile.mkstemp(prefix=".delta-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    segment_path = snapshot_path + ".bin.gz"
+    codec = active_codec()
+    base_path = snapshot_path + CODEC_SUFFIXES[codec]
+    try:
+        snapshot_db(snapshot_path)
+        page_size = _page_size(snapshot_path)
+        hashes = page_hashes(snapshot_path, page_size)
+        loaded = _load_state()
+        state = loaded[0] if loaded else None
+
+        if (state is None or state["page_size"] != page_size or state["seq"] >= DELTA_MAX_CHAIN
+                or state["delta_bytes"] > DELTA_REBASE_RATIO * state["base_bytes"]):
+            base_id = datetime.now().strftime(BASE_ID_FORMAT)
+            name = f"{BASE_PREFIX}{base_id}.db{CODEC_SUFFIXES[codec]}"
+            if codec != "none":
+                compress_file(snapshot_path, base_path, codec)
+            if not store.upload(base_path, name):
+                return False
+            _save_state({"base_id": base_id, "seq": 0, "page_size": page_size,
+                         "base_bytes": os.path.getsize(snapshot_path), "delta_bytes": 0}, hashes)
+            print(f"📦 Shipped new delta base {name} ({len(hashes) // HASH_SIZE} pages, "
+                  f"{os.path.getsize(base_path)} bytes).")
+            # Only a new base can retire an older chain
+            prune_delta_chains(store)
+            return True
+
+        if hashes == loaded[1]:
+            print("✅ Delta backup: no pages changed since the last one.")
+            return True
+
+        seq = state["seq"] + 1
+        changed = write_segment(snapshot_path, segment_path, page_size, loaded[1], hashes, seq)
+        name = f"{DELTA_PREFIX}{state['base_id']}_{seq:05d}.bin.gz"
+        if not store.upload(segment_path, name):
+            return False
+        size = os.path.getsize(segment_path)
+        _save_state({**state, "seq": seq, "delta_bytes": state["delta_bytes"] + size}, hashes)
+        print(f"📦 Shipped {name}: {changed} changed pages, {size} bytes.")
+        return True
+    finally:
+        for path in {snapshot_path, segment_path, base_path}:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def prune_delta_chains(store) -> None:
+    """Apply the hourly/daily/monthly retention tiers to the delta chains on ``store``.
+
+    A chain is dated by its base and kept or dropped whole, since each delta
+    needs its base and every delta before it. Bases go first: deltas left
+    behind by an interrupted prune belong to no base and go next time.
+    """
+    try:
+        bases = {_base_id(name): name for name in store.list(BASE_PREFIX)}
+        keep = retained((base_id, datetime.strptime(base_id, BASE_ID_FORMAT)) for base_id in bases)
+        for base_id, name in bases.items():
+            if base_id not in keep:
+                store.delete(name)
+        for name in store.list(DELTA_PREFIX):
+            if _delta_base_id(name) not in keep:
+                store.delete(name)
+        print(f"🧹 Delta retention: kept {len(keep)} of {len(bases)} chains.")
+    except Exception as e:
+        print(f"⚠️ Delta retention skipped: {type(e).__name__}: {e}")
+
+
+# === Restore ===
+def chain_tip(store) -> Tuple[str, List[str]]:
+    """The newest base on ``store`` and its deltas, in order."""
+    bases = store.list(BASE_PREFIX)
+    if not bases:
+        raise FileNotFoundError("no delta backup base found")
+    return bases[-1], store.list(f"{DELTA_PREFIX}{_base_id(bases[-1])}_")
+
+
+def rebuild_latest(store, dest_path: str, tip: Optional[Tuple[str, List[str]]] = None,
+                   progress=None) -> Tuple[str, int, bytes]:
+    """Download the newest base and replay its deltas into ``dest_path``.
+
+    ``tip`` is a chain_tip() already fetched. Returns (base_id, seq, page
+    hashes of the rebuilt file).
+    """
+    base_name, deltas = tip or chain_tip(store)
+    base_id = _base_id(base_name)
+
+    seq, digest = 0, None
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(dest_path) or ".") as work:
+        base_path = os.path.join(work, base_name)
+        store.download(base_name, base_path)
+        # Bases from before compression are plain .db files
+        decompress_file(base_path, dest_path)
+        os.remove(base_path)
+        for name in deltas:
+            segment_path = os.path.join(work, name)
+            store.download(name, segment_path)
+            seq += 1
+            _, digest = apply_segment(dest_path, segment_path, seq)
+            os.remove(segment_path)
+            if progress:
+                progress("downloading", seq / len(deltas))
+
+    # Checked once at the end: the last segment records the state the chain leads to
+    hashes = page_hashes(dest_path, _page_size(dest_path))
+    if digest is not None and _state_digest(hashes) != digest:
+        raise ValueError(f"database rebuilt from base {base_id} + {seq} deltas does not match the last delta")
+
+    check = sqlite3.connect(dest_path)
+    try:
+        result = check.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        check.close()
+    if result != "ok":
+        raise sqlite3.DatabaseError(f"rebuilt database failed quick_check: {result}")
+    return base_id, seq, hashes
+
+
+def restore_delta_backup(store=None, force: bool = False, progress=None) -> bool:
+    """restore_from_drive() for BACKUP_MODE=delta: base + deltas, swapped in atomically.
+
+    Skipped when the local delta state already is the store's chain tip.
+    """
+    store = store or default_store()
+    progress = progress or (lambda stage, fraction=None: None)
+    ensure_backup_folder()
+    progress("checking")
+    try:
+        tip = chain_tip(store)
+    except Exception as e:
+        print(f"❌ Delta restore failed: {type(e).__name__}: {e}")
+        return False
+    state = _load_state()
+    base_id = _base_id(tip[0])
+    if (not force and state and os.path.exists(DB_PATH)
+            and (state[0]["base_id"], state[0]["seq"]) == (base_id, len(tip[1]))):
+        print(f"✅ Local database already matches delta base {base_id} + {len(tip[1])} deltas; skipping restore.")
+        progress("skipped", 1.0)
+        return True
+
+    fd, rebuilt_path = tempfile.mkstemp(prefix=".restore-", suffix=".db", dir=os.path.dirname(DB_PATH))
+    os.close(fd)
+    try:
+        progress("downloading", 0.0)
+        base_id, seq, hashes = rebuild_latest(store, rebuilt_path, tip, progress)
+        page_size = _page_size(rebuilt_path)
+
+        progress("restoring")
+        replace_db(rebuilt_path)
+    except Exception as e:
+        print(f"❌ Delta restore failed: {type(e).__name__}: {e}")
+        return False
+    finally:
+        if os.path.exists(rebuilt_path):
+            os.remove(rebuilt_path)
+
+    # The next backup continues this chain (delta_bytes is only known if we built it)
+    delta_bytes = state[0]["delta_bytes"] if state and state[0]["base_id"] == base_id else 0
+    _save_state({"base_id": base_id, "seq": seq, "page_size": page_size,
+                 "base_bytes": len(hashes) // HASH_SIZE * page_size, "delta_bytes": delta_bytes}, hashes)
+
+    print(f"✅ Restored database from delta base {base_id} + {seq} deltas to {DB_PATH}")
+    return True
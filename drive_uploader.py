@@ -2,11 +2,22 @@
 
 import os
 import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import tempfile
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.http import MediaIoBaseDownload
-from database_utils import DB_PATH, ensure_payment_timestamp_column, ensure_receipt_no_column_exists
+from database_utils import DB_PATH, BACKUP_DIR, ensure_backup_folder, replace_db
+from import_jobs import imports_paused
+from backup_archive import codec_for, decompress_file, retained, COPY_CHUNK_SIZE
+from datetime import datetime
 
 # Load credentials from Railway environment variable
 service_account_info = json.loads(os.environ['GOOGLE_SERVICE_ACCOUNT'])
@@ -19,6 +30,27 @@ creds = service_account.Credentials.from_service_account_info(
 FOLDER_ID = '1cC4D1oNqRHh-Y4v3RiI8iLmLTMyrO8Us'
 SIAM_FOLDER_ID = '17iK32icxbXDKr-0MiiYZUaUmSElbcL9F'
 
+# "full" uploads the whole database each time; "delta" ships changed pages
+BACKUP_MODE = os.getenv("BACKUP_MODE", "full").lower()
+
+# Drive downloads/uploads block for seconds; async routes await them here
+DRIVE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="drive")
+
+# The newest backup on Drive the local database is known to match: written
+# after every upload and restore, so a login restore can skip the download
+# when nothing newer has appeared on Drive since
+SYNC_STATE_PATH = os.path.join(BACKUP_DIR, "drive_sync.json")
+SYNC_FIELDS = ("id", "name", "md5Checksum", "size", "modifiedTime")
+# Held by a restore for its whole run and by a backup while it uploads, so a
+# backup of the old database can never land on Drive behind a restore
+DRIVE_SYNC_LOCK = threading.Lock()
+
+
+async def run_drive(func, *args, **kwargs):
+    """Run a blocking Drive call on DRIVE_EXECUTOR and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DRIVE_EXECUTOR, functools.partial(func, *args, **kwargs))
+
 # In drive_uploader.py
 
 def upload_to_drive(file_path, file_name):
@@ -34,11 +66,14 @@ def upload_to_drive(file_path, file_name):
         uploaded_file = service.files().create(
             body=file_metadata,
             media_body=media,
-            fields='id'
+            fields='id, name, md5Checksum, size, modifiedTime'
         ).execute()
 
         file_id = uploaded_file.get('id')
         print(f"✅ Uploaded to Google Drive with file ID: {file_id}")
+        if file_name.startswith("bills_backup"):
+            # Drive now holds what we have; the next login need not download it
+            save_sync_state(uploaded_file)
         
         # 🟢 CRITICAL FIX: Explicitly return True on success
         return True 
@@ -49,47 +84,235 @@ def upload_to_drive(file_path, file_name):
         return False # 🔴 Explicitly return False on failure
 
 
+def load_sync_state():
+    try:
+        with open(SYNC_STATE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_sync_state(drive_file):
+    ensure_backup_folder()
+    state = {key: drive_file.get(key) for key in SYNC_FIELDS}
+    with open(SYNC_STATE_PATH + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(SYNC_STATE_PATH + ".tmp", SYNC_STATE_PATH)
+
+
+def matches_sync_state(drive_file, state) -> bool:
+    """Whether ``drive_file`` is the backup the local database was last synced with.
+
+    The md5 decides when Drive reports one; otherwise size + modifiedTime.
+    """
+    if not state or state.get("id") != drive_file.get("id"):
+        return False
+    if drive_file.get("md5Checksum") and state.get("md5Checksum"):
+        return drive_file["md5Checksum"] == state["md5Checksum"]
+    return (drive_file.get("size"), drive_file.get("modifiedTime")) == (state.get("size"), state.get("modifiedTime"))
+
 
-def restore_from_drive():
+def list_drive_files(prefix):
+    """Files in FOLDER_ID whose name starts with ``prefix``, oldest first."""
     service = build('drive', 'v3', credentials=creds)
+    query = f"name contains '{prefix}' and '{FOLDER_ID}' in parents and trashed = false"
+    files, page_token = [], None
+    while True:
+        response = service.files().list(
+            q=query,
+            spaces='drive',
+            fields='nextPageToken, files(id, name, size, createdTime)',
+            orderBy='createdTime',
+            pageSize=1000,
+            pageToken=page_token
+        ).execute()
+        files.extend(f for f in response.get('files', []) if f['name'].startswith(prefix))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+def download_from_drive(file_id, dest_path, progress=None):
+    """Download a Drive file to ``dest_path``; returns the md5 hex digest of what was written.
+
+    ``progress(fraction)`` is called after every chunk.
+    """
+    service = build('drive', 'v3', credentials=creds)
+    request = service.files().get_media(fileId=file_id)
+    with open(dest_path, 'wb') as f:
+        downloader = MediaIoBaseDownload(f, request, chunksize=8 * COPY_CHUNK_SIZE)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+            if progress and status:
+                progress(status.progress())
+    md5 = hashlib.md5()
+    with open(dest_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def delete_from_drive(file_id):
+    service = build('drive', 'v3', credentials=creds)
+    service.files().delete(fileId=file_id).execute()
+
 
-    folder_id = FOLDER_ID
+def prune_drive_backups():
+    """Apply the hourly/daily/monthly retention tiers to full backups on Drive."""
+    try:
+        files = list_drive_files("bills_backup")
+        created = [(f['id'], datetime.fromisoformat(f['createdTime'].replace('Z', '+00:00'))) for f in files]
+        keep = retained(created)
+        for file_id, _ in created:
+            if file_id not in keep:
+                delete_from_drive(file_id)
+        print(f"🧹 Drive retention: kept {len(keep)} of {len(files)} backups.")
+    except Exception as e:
+        print(f"⚠️ Drive retention skipped: {type(e).__name__}: {e}")
 
-    # Search for files starting with 'bills_backup' in the given folder
-    query = f"name contains 'bills_backup' and '{folder_id}' in parents and trashed = false"
+
+def latest_drive_backup():
+    """Metadata of the newest full backup on Drive, or None."""
+    service = build('drive', 'v3', credentials=creds)
+    query = f"name contains 'bills_backup' and '{FOLDER_ID}' in parents and trashed = false"
     response = service.files().list(
         q=query,
         spaces='drive',
-        fields='files(id, name, createdTime)',
+        fields='files(id, name, md5Checksum, size, modifiedTime, createdTime)',
         orderBy='createdTime desc',
         pageSize=1
     ).execute()
-
     files = response.get('files', [])
+    return files[0] if files else None
 
-    if not files:
-        print("❌ No backup files found in Google Drive.")
-        return False
 
-    latest_file = files[0]
-    file_id = latest_file['id']
-    file_name = latest_file['name']
+def _quick_check(path):
+    check = sqlite3.connect(path)
+    try:
+        result = check.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        check.close()
+    if result != "ok":
+        raise sqlite3.DatabaseError(f"downloaded database failed quick_check: {result}")
+
 
-    print(f"📦 Restoring latest backup: {file_name}")
+def restore_from_drive(force=False, progress=None):
+    """Replace the local database with the newest Drive backup.
 
-    request = service.files().get_media(fileId=file_id)
+    Skipped (returning True) when that backup is the one the local database
+    was last synced with, unless ``force``. ``progress(stage, fraction)``
+    reports waiting / checking / downloading / verifying / restoring / skipped.
+    CSV imports are finished first and held off until the restore is done.
+    """
+    progress = progress or (lambda stage, fraction=None: None)
+    progress("waiting")
+    with imports_paused(), DRIVE_SYNC_LOCK:
+        if BACKUP_MODE == "delta":
+            # Base + delta chain instead of one full copy (see delta_backup.py)
+            from delta_backup import restore_delta_backup
+            return restore_delta_backup(force=force, progress=progress)
+
+        progress("checking")
+        latest_file = latest_drive_backup()
+        if latest_file is None:
+            print("❌ No backup files found in Google Drive.")
+            return False
+        file_name = latest_file['name']
+
+        if not force and os.path.exists(DB_PATH) and matches_sync_state(latest_file, load_sync_state()):
+            print(f"✅ Local database already matches {file_name}; skipping Drive restore.")
+            progress("skipped", 1.0)
+            return True
+
+        print(f"📦 Restoring latest backup: {file_name}")
+
+        # Download (and decompress) beside the live database, then swap it in
+        db_dir = os.path.dirname(DB_PATH) or "."
+        fd, download_path = tempfile.mkstemp(prefix=".download-", dir=db_dir)
+        os.close(fd)
+        fd, restored_path = tempfile.mkstemp(prefix=".restore-", suffix=".db", dir=db_dir)
+        os.close(fd)
+        try:
+            progress("downloading", 0.0)
+            md5 = download_from_drive(latest_file['id'], download_path,
+                                      lambda fraction: progress("downloading", fraction))
+            progress("verifying")
+            if latest_file.get('md5Checksum') and md5 != latest_file['md5Checksum']:
+                raise ValueError(f"{file_name}: md5 {md5} does not match Drive's {latest_file['md5Checksum']}")
+            if latest_file.get('size') and os.path.getsize(download_path) != int(latest_file['size']):
+                raise ValueError(f"{file_name}: downloaded {os.path.getsize(download_path)} of {latest_file['size']} bytes")
+            decompress_file(download_path, restored_path, codec_for(file_name))
+            _quick_check(restored_path)
+
+            progress("restoring")
+            replace_db(restored_path)
+        finally:
+            for path in (download_path, restored_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        save_sync_state(latest_file)
+        print(f"✅ Restored database from Google Drive backup ({file_name}) to {DB_PATH}")
+        return True
+
+
+class RestoreJob:
+    """Runs restore_from_drive() on its own thread and keeps its progress for polling.
+
+    Only one restore runs at a time; start() while one is running joins it.
+    """
+
+    def __init__(self, restore=restore_from_drive):
+        self.restore = restore
+        self._lock = threading.Lock()
+        self._thread = None
+        self._status = {"state": "idle"}
+
+    def running(self) -> bool:
+        with self._lock:
+            return self._thread is not None
+
+    def start(self, force=False) -> bool:
+        """Start a restore; returns False if one was already running."""
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._status = {"state": "running", "stage": "queued", "progress": None, "force": force,
+                            "started_at": time.time(), "finished_at": None, "error": None}
+            self._thread = threading.Thread(target=self._run, args=(force,), name="drive-restore", daemon=True)
+            self._thread.start()
+            return True
+
+    def _progress(self, stage, fraction=None):
+        with self._lock:
+            self._status["stage"] = stage
+            self._status["progress"] = fraction
+
+    def _run(self, force):
+        error = None
+        try:
+            ok = self.restore(force=force, progress=self._progress)
+            if not ok:
+                error = "Restore failed; see the server log"
+        except Exception as e:
+            ok = False
+            error = f"{type(e).__name__}: {e}"
+            print(f"❌ Drive restore failed: {error}")
+        with self._lock:
+            if ok:
+                state = "skipped" if self._status["stage"] == "skipped" else "done"
+            else:
+                state = "failed"
+            self._status.update(state=state, error=error, finished_at=time.time())
+            self._thread = None
+
+    def status(self):
+        with self._lock:
+            return dict(self._status)
 
-    with open(DB_PATH, 'wb') as f:
-        downloader = MediaIoBaseDownload(f, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            print(f"⬇️ Download progress: {int(status.progress() * 100)}%")
 
-    ensure_payment_timestamp_column()
-    ensure_receipt_no_column_exists()
-    print(f"✅ Restored database from Google Drive backup ({file_name}) to {DB_PATH}")
-    return True
+DRIVE_RESTORE = RestoreJob()
 
 
 def upload_to_drive_siam(file_path, file_name):
@@ -0,0 +1,200 @@
+import os
+import csv
+import shutil
+import itertools
+import threading
+import queue
+import json
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional, Dict
+
+from database_utils import db_connection, import_bill_rows, iter_text_lines, CSV_CHUNK_SIZE
+from tariff import find_batch_mismatches
+
+# Uploaded CSVs wait here until their import job finishes
+IMPORT_SPOOL_DIR = "app/db/imports"
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+_job_queue = queue.Queue()
+_worker_thread: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+# Jobs queued or running, and whether new ones are refused (see imports_paused)
+_jobs_state = threading.Condition()
+_unfinished_jobs = 0
+_paused = False
+
+
+class ImportsPaused(RuntimeError):
+    """A database restore is in progress; no import job can be queued."""
+
+
+def _now():
+    return datetime.now().strftime(TIMESTAMP_FORMAT)
+
+
+def create_import_job(source_file, filename: str) -> str:
+    """Spool an uploaded CSV to disk, record a queued job and return its id."""
+    global _unfinished_jobs
+    job_id = uuid.uuid4().hex
+    os.makedirs(IMPORT_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(IMPORT_SPOOL_DIR, f"{job_id}.csv")
+
+    source_file.seek(0)
+    with open(spool_path, "wb") as spool:
+        shutil.copyfileobj(source_file, spool, CSV_CHUNK_SIZE)
+
+    with _jobs_state:
+        if _paused:
+            os.remove(spool_path)
+            raise ImportsPaused("database restore in progress")
+        with db_connection() as conn:
+            conn.execute(
+                "INSERT INTO import_jobs (id, filename, spool_path, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, filename, spool_path, _now())
+            )
+        _unfinished_jobs += 1
+        _job_queue.put(job_id)
+    print(f"📥 Queued import job {job_id} for {filename}")
+    return job_id
+
+
+def get_import_job(job_id: str) -> Optional[Dict]:
+    """Job progress for /admin/jobs/{id}, including rows per second for the current run."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job = dict(row)
+    job.pop("spool_path")
+    # First rows whose amounts differ from the tariff: [{"row", "user_id", "pay_period", "bill_amount"}]
+    job["tariff_mismatch_rows"] = json.loads(job["tariff_mismatch_rows"] or "[]")
+    job["rows_per_second"] = None
+    if job["started_at"] and job["updated_at"]:
+        elapsed = (
+            datetime.strptime(job["updated_at"], TIMESTAMP_FORMAT)
+            - datetime.strptime(job["started_at"], TIMESTAMP_FORMAT)
+        ).total_seconds()
+        if elapsed > 0:
+            job["rows_per_second"] = round((job["processed"] - job["resumed_from"]) / elapsed, 1)
+    return job
+
+
+def _run_import_job(job_id: str):
+    with db_connection() as conn:
+        job = conn.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or job["status"] in ("done", "failed"):
+            return
+        conn.execute(
+            "UPDATE import_jobs SET status = 'running', error_message = NULL, started_at = ?, updated_at = ?, resumed_from = processed WHERE id = ?",
+            (_now(), _now(), job_id)
+        )
+
+    counts = {key: job[key] for key in ("processed", "inserted", "duplicates", "errors", "tariff_mismatches")}
+    counts["tariff_mismatch_rows"] = json.loads(job["tariff_mismatch_rows"] or "[]")
+    if counts["processed"]:
+        print(f"🔁 Resuming import job {job_id} after {counts['processed']} rows")
+
+    def checkpoint(conn, progress):
+        # Runs inside each batch's transaction, so a restart resumes right after it
+        conn.execute("""
+            UPDATE import_jobs
+            SET processed = ?, inserted = ?, duplicates = ?, errors = ?, tariff_mismatches = ?,
+                tariff_mismatch_rows = ?, updated_at = ?
+            WHERE id = ?
+        """, (progress["processed"], progress["inserted"], progress["duplicates"], progress["errors"],
+              progress["tariff_mismatches"], json.dumps(progress["tariff_mismatch_rows"]), _now(), job_id))
+
+    try:
+        with open(job["spool_path"], "rb") as spool:
+            reader = csv.DictReader(iter_text_lines(spool))
+            # Rows before the last committed batch were already imported
+            remaining = itertools.islice(reader, counts["processed"], None)
+            counts = import_bill_rows(
+                remaining, checkpoint=checkpoint, counts=counts, validate_batch=find_batch_mismatches
+            )
+    except Exception as e:
+        print(f"❌ Import job {job_id} failed: {type(e).__name__}: {e}")
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE import_jobs SET status = 'failed', error_message = ?, finished_at = ? WHERE id = ?",
+                (f"{type(e).__name__}: {e}", _now(), job_id)
+            )
+        return
+
+    with db_connection() as conn:
+        conn.execute("UPDATE import_jobs SET status = 'done', finished_at = ? WHERE id = ?", (_now(), job_id))
+    os.remove(job["spool_path"])
+    print(f"✅ Import job {job_id}: inserted {counts['inserted']} new rows from {job['filename']} "
+          f"({counts['duplicates']} duplicates, {counts['errors']} errors, "
+          f"{counts['tariff_mismatches']} differ from the tariff)")
+    return counts
+
+
+def _import_worker(on_complete):
+    while True:
+        job_id = _job_queue.get()
+        try:
+            if _run_import_job(job_id) is not None and on_complete is not None:
+                on_complete(job_id)
+        except Exception as e:
+            print(f"❌ Import worker error on job {job_id}: {type(e).__name__}: {e}")
+        finally:
+            _job_queue.task_done()
+            _job_finished()
+
+
+def _job_finished():
+    global _unfinished_jobs
+    with _jobs_state:
+        _unfinished_jobs -= 1
+        _jobs_state.notify_all()
+
+
+@contextmanager
+def imports_paused():
+    """Hold off CSV imports while the database file is replaced.
+
+    Waits for queued and running jobs to finish (their rows and job records
+    live in that file), then refuses new ones until the block exits.
+    """
+    global _paused
+    with _jobs_state:
+        if _unfinished_jobs:
+            print(f"⏸️ Waiting for {_unfinished_jobs} import job(s) to finish before the restore")
+        # Without a worker (e.g. a maintenance script) queued jobs never drain
+        _jobs_state.wait_for(lambda: _unfinished_jobs == 0 or _worker_thread is None)
+        _paused = True
+    try:
+        yield
+    finally:
+        with _jobs_state:
+            _paused = False
+
+
+def start_import_worker(on_complete=None):
+    """Start the single import worker and re-queue jobs a restart interrupted.
+
+    ``on_complete(job_id)`` runs on the worker thread after each successful import.
+    """
+    global _worker_thread, _unfinished_jobs
+    with _worker_lock:
+        if _worker_thread is not None:
+            return
+
+        with db_connection() as conn:
+            unfinished = conn.execute(
+                "SELECT id FROM import_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        with _jobs_state:
+            for row in unfinished:
+                _unfinished_jobs += 1
+                _job_queue.put(row["id"])
+        if unfinished:
+            print(f"🔁 Re-queued {len(unfinished)} unfinished import jobs")
+
+        _worker_thread = threading.Thread(target=_import_worker, args=(on_complete,), name="csv-import", daemon=True)
+        _worker_thread.start()
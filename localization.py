@@ -0,0 +1,117 @@
+import sys
+import time
+import functools
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+import pytz
+
+# Indonesian date formatting for templates and JSON. Stored timestamps are
+# UTC "YYYY-MM-DD HH:MM:SS" strings and are shown in WIB. The zone is looked
+# up once, and each distinct timestamp is formatted once: a page of bills
+# repeats the same few payment times many times over.
+WIB = pytz.timezone("Asia/Jakarta")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+FORMAT_CACHE_SIZE = 65536
+
+MONTHS = (
+    "Januari", "Februari", "Maret", "April", "Mei", "Juni",
+    "Juli", "Agustus", "September", "Oktober", "November", "Desember"
+)
+SHORT_MONTHS = (
+    "Jan", "Feb", "Mar", "Apr", "Mei", "Jun",
+    "Jul", "Ags", "Sep", "Okt", "Nov", "Des"
+)
+
+
+def to_wib(value: str) -> datetime:
+    # fromisoformat is several times faster than strptime; the shape check
+    # keeps it to exactly what TIMESTAMP_FORMAT would have accepted
+    if len(value) != 19 or value[10] != " ":
+        raise ValueError(f"not a {TIMESTAMP_FORMAT} timestamp: {value!r}")
+    return datetime.fromisoformat(value).replace(tzinfo=pytz.UTC).astimezone(WIB)
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def indo_datetime(value: str) -> str:
+    """'2024-03-05 02:30:00' -> '5 Maret 2024, 09:30 WIB'; anything unparseable comes back as is."""
+    try:
+        wib_dt = to_wib(value)
+    except (TypeError, ValueError):
+        return value
+    return f"{wib_dt.day} {MONTHS[wib_dt.month - 1]} {wib_dt.year}, {wib_dt.hour:02d}:{wib_dt.minute:02d} WIB"
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def indo_shortdate(value: str) -> str:
+    """'2024-03-05 02:30:00' -> '5-Mar-2024, 09:30 WIB'; anything unparseable comes back as is."""
+    try:
+        wib_dt = to_wib(value)
+    except (TypeError, ValueError):
+        return value
+    return f"{wib_dt.day}-{SHORT_MONTHS[wib_dt.month - 1]}-{wib_dt.year}, {wib_dt.hour:02d}:{wib_dt.minute:02d} WIB"
+
+
+def format_timestamps(values: Iterable[Optional[str]], formatter=indo_shortdate) -> Dict[str, str]:
+    """Format every distinct timestamp of a result set in one pass.
+
+    Returns ``{timestamp: formatted}`` (empty values skipped), ready to look
+    up while building rows, and leaves the filters' cache warm for a render.
+    """
+    return {value: formatter(value) for value in set(values) if value}
+
+
+def register_filters(env):
+    """Install indo_datetime / indo_shortdate on a Jinja2 environment."""
+    env.filters["indo_datetime"] = indo_datetime
+    env.filters["indo_shortdate"] = indo_shortdate
+
+
+# === Micro-benchmark ===
+def _uncached_shortdate(value: str):
+    # The per-call filter this module replaced, kept for comparison
+    try:
+        utc_dt = datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=pytz.UTC)
+        wib_dt = utc_dt.astimezone(pytz.timezone("Asia/Jakarta"))
+        months = [
+            "Jan", "Feb", "Mar", "Apr", "Mei", "Jun",
+            "Jul", "Ags", "Sep", "Okt", "Nov", "Des"
+        ]
+        return f"{wib_dt.day}-{months[wib_dt.month - 1]}-{wib_dt.year}, {wib_dt.strftime('%H:%M')} WIB"
+    except Exception:
+        return value
+
+
+def benchmark(rows: int = 20000, distinct: int = 500) -> Dict[str, float]:
+    """Time formatting ``rows`` timestamps drawn from ``distinct`` payment times."""
+    values = [f"2024-{(i % 12) + 1:02d}-{(i % 28) + 1:02d} {i % 24:02d}:{i % 60:02d}:00" for i in range(distinct)]
+    column = [values[i % distinct] for i in range(rows)]
+
+    def timed(func) -> float:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    indo_shortdate.cache_clear()
+    uncached = timed(lambda: [_uncached_shortdate(value) for value in column])
+    cold = timed(lambda: [indo_shortdate(value) for value in column])
+    warm = timed(lambda: [indo_shortdate(value) for value in column])
+    indo_shortdate.cache_clear()
+    batch = timed(lambda: [lookup[value] for lookup in [format_timestamps(column)] for value in column])
+
+    assert [indo_shortdate(value) for value in values] == [_uncached_shortdate(value) for value in values]
+    return {
+        "rows": rows,
+        "distinct": distinct,
+        "uncached_ms": round(uncached * 1000, 2),
+        "cached_cold_ms": round(cold * 1000, 2),
+        "cached_warm_ms": round(warm * 1000, 2),
+        "batch_ms": round(batch * 1000, 2),
+        "speedup_warm": round(uncached / warm, 1) if warm else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    # python localization.py [rows] [distinct]
+    result = benchmark(*(int(arg) for arg in sys.argv[1:3]))
+    print(f"⏱️ {result}")
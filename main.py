@@ -1,22 +1,30 @@
-from fastapi import FastAPI, Request, Form, UploadFile, File, Depends, HTTPException, Response, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Form, UploadFile, File, Depends, HTTPException, Response, Query, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import sqlite3
-import csv
 import os
-import io
+import gzip
+from urllib.parse import urlencode
 from typing import List
 from typing import Optional
 from starlette.middleware.sessions import SessionMiddleware
-from database_utils import restore_db, backup_db, get_db_connection, DB_PATH
+from database_utils import restore_db, backup_db, run_db, run_db_shared, DB_FLIGHTS, iterate_db, stream_connection, PoolTimeout, DB_PATH
 from datetime import datetime, timedelta, timezone
 from drive_uploader import upload_to_drive
-from drive_uploader import restore_from_drive
-from database_utils import mark_bills_as_paid, cancel_bills_payment, ensure_payment_timestamp_column
-from database_utils import get_daily_payment_summary, get_bills_by_date, ensure_receipt_no_column_exists
-from backup_dependency import BackupOnWrite
-import pytz
+from drive_uploader import DRIVE_RESTORE, run_drive
+from database_utils import mark_bills_as_paid, cancel_bills_payment
+from database_utils import stream_daily_payment_summary, stream_bills_by_date
+from database_utils import stream_admin_dashboard, get_bills_page, get_bills_total, BILLS_PAGE_SIZE, stream_shopping_cart, get_user_bills, get_invoice
+from database_utils import get_bill, get_paid_bills, search_bills, update_bill, delete_bill
+from backup_dependency import BackupOnWrite, BACKUP_SCHEDULER
+from single_flight import SingleFlight
+from response_cache import PAGE_CACHE, USER_PAGE_CACHE, data_version_time, user_data_version, http_date, is_not_modified, make_etag
+from receipt_cache import RECEIPT_CACHE, RECEIPT_TEMPLATES
+from import_jobs import create_import_job, get_import_job, start_import_worker, ImportsPaused
+from tariff import revalidate_bills
+from localization import WIB, format_timestamps, register_filters
+from bulk_invoices import iter_invoice_document, iter_invoice_zip
 
 app = FastAPI()
 
@@ -44,51 +52,122 @@ def check_admin_logged_in(request: Request):
     if request.cookies.get("admin_logged_in") != "true":
         raise HTTPException(status_code=307, detail="Redirecting to login", headers={"Location": "/admin/login"})
 
-# Define and register custom filter for Indonesian-style datetime
-def format_indonesian_datetime(value: str):
-    try:
-        utc_dt = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.UTC)
-        wib_tz = pytz.timezone("Asia/Jakarta")
-        wib_dt = utc_dt.astimezone(wib_tz)
-        months = [
-            "Januari", "Februari", "Maret", "April", "Mei", "Juni",
-            "Juli", "Agustus", "September", "Oktober", "November", "Desember"
-        ]
-        return f"{wib_dt.day} {months[wib_dt.month - 1]} {wib_dt.year}, {wib_dt.strftime('%H:%M')} WIB"
-    except Exception:
-        return value
-
-# Register filter with Jinja2
-templates.env.filters["indo_datetime"] = format_indonesian_datetime
-
-
-# Define and register custom filter for Indonesian-style short-date dd-mmm-yyyy
-def format_indonesian_shortdate(value: str):
-    try:
-        utc_dt = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.UTC)
-        wib_tz = pytz.timezone("Asia/Jakarta")
-        wib_dt = utc_dt.astimezone(wib_tz)
-        months = [
-            "Jan", "Feb", "Mar", "Apr", "Mei", "Jun",
-            "Jul", "Ags", "Sep", "Okt", "Nov", "Des"
-        ]
-        return f"{wib_dt.day}-{months[wib_dt.month - 1]}-{wib_dt.year}, {wib_dt.strftime('%H:%M')} WIB"
-    except Exception:
-        return value
+# Every pooled connection stayed busy for DB_POOL_TIMEOUT_SECONDS: shed load instead of queueing forever
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    print(f"⚠️ {request.url.path}: {exc}")
+    return JSONResponse({"error": "Server busy, try again shortly"}, status_code=503, headers={"Retry-After": "5"})
+
+# Indonesian-style datetime / short-date filters (WIB), memoised per timestamp
+register_filters(templates.env)
+
+
+# Streamed pages: rows are read from a lazy cursor while the template renders,
+# so the browser starts painting before the last row has been fetched
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def _render_chunks(template_name: str, context: dict, loader, *args):
+    with stream_connection() as conn:
+        context.update(loader(conn, *args))
+        pending, size = [], 0
+        for piece in templates.get_template(template_name).generate(context):
+            pending.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(pending)
+                pending, size = [], 0
+        yield "".join(pending)
 
-# Register filter short-date with Jinja2
-templates.env.filters["indo_shortdate"] = format_indonesian_shortdate
+
+def stream_template(template_name: str, context: dict, loader, *args):
+    """Streaming TemplateResponse; loader(conn, *args) supplies the row context."""
+    return StreamingResponse(
+        iterate_db(_render_chunks(template_name, context, loader, *args)),
+        media_type="text/html"
+    )
+
+
+# Read-heavy pages are cached until the next write bumps the data version
+VALIDATOR_HEADERS = ("etag", "last-modified", "cache-control")
+# Concurrent misses for the same page render it once
+PAGE_FLIGHTS = SingleFlight()
+
+
+async def cached_page(request: Request, route: str, params: tuple, render):
+    """Serve the page built by ``await render()`` from PAGE_CACHE when possible.
+
+    Pages that carry an ETag / Last-Modified answer matching conditional
+    requests with 304; a cached page does so without touching the database.
+    """
+    key = PAGE_CACHE.key(route, *params)
+    cached = PAGE_CACHE.get(key)
+    if cached is not None:
+        body, headers = cached
+        response = HTMLResponse(body, headers=headers)
+    else:
+        response, shared = await PAGE_FLIGHTS.do(key, render)
+        if shared:
+            # Streams are consumed by one client; render() only sets one up, so start our own
+            if isinstance(response, StreamingResponse):
+                response = await render()
+            else:
+                response = Response(response.body, status_code=response.status_code,
+                                    headers=_validators(response), media_type=response.media_type)
+        elif isinstance(response, StreamingResponse):
+            response.body_iterator = _cache_stream(key, response.body_iterator)
+        elif response.status_code == 200:
+            PAGE_CACHE.put(key, (response.body, _validators(response)), size=len(response.body))
+
+    return not_modified_or(request, response)
+
+
+def _validators(response: Response) -> dict:
+    return {name: response.headers[name] for name in VALIDATOR_HEADERS if name in response.headers}
+
+
+def not_modified_or(request: Request, response: Response) -> Response:
+    """A bodyless 304 when the client's validators still match ``response``."""
+    if response.status_code == 200 and is_not_modified(request.headers, response.headers):
+        return Response(status_code=304, headers=_validators(response))
+    return response
+
+
+async def _cache_stream(key: tuple, chunks):
+    # Pass chunks through and store the page once it has been sent in full
+    body, size = [], 0
+    try:
+        async for chunk in chunks:
+            if size <= PAGE_CACHE.max_bytes:
+                body.append(chunk)
+                size += len(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+    if size <= PAGE_CACHE.max_bytes:
+        body = "".join(body).encode("utf-8")
+        PAGE_CACHE.put(key, (body, {}), size=len(body))
 
 
 # Database restore and backup functions at startup and shutdown events
 @app.on_event("startup")
 def startup_event():
     restore_db()
+    BACKUP_SCHEDULER.start()
+    start_import_worker(on_complete=backup_after_import)
 
 @app.on_event("shutdown")
 async def on_shutdown():
     print("Shutting down app... Backing up database.")
+    await run_db(backup_db)
+    # Ship writes still inside the debounce window before the process exits
+    if not await run_drive(BACKUP_SCHEDULER.flush, 60):
+        print("⚠️ Pending Drive backup did not finish before shutdown.")
+
+# Runs on the import worker thread once a CSV import job has finished
+def backup_after_import(job_id: str):
     backup_db()
+    BACKUP_SCHEDULER.request_backup()
 
 # Test DB connection to ensure it's working
 def test_db_connection():
@@ -113,22 +192,11 @@ async def login(request: Request, password: str = Form(...)):
     correct_password = os.getenv("ADMIN_PASSWORD")
 
     if password == correct_password:
-        # --- 🟢 GENIUS MODIFICATION START ---
-        print("🔑 Credentials valid. Starting Auto-Restore from Google Drive...")
-        
-        # Execute the restore logic
-        # Note: This will make the login take a few seconds to complete
-        restore_success = restore_from_drive()
-
-        if not restore_success:
-            # If restore fails, stop the login and show error
-            return templates.TemplateResponse("login.html", {
-                "request": request, 
-                "error": "CRITICAL: Database Restore Failed. Check Google Drive connection."
-            })
-        
-        print("✅ Database restored successfully. Redirecting to dashboard.")
-        # --- 🔴 GENIUS MODIFICATION END ---
+        # Sync from Google Drive on its own thread; it skips the download when
+        # the local database already matches the newest backup there.
+        # The dashboard polls /admin/restore_status until it has finished.
+        if DRIVE_RESTORE.start():
+            print("🔑 Credentials valid. Checking Google Drive for a newer backup...")
 
         response = RedirectResponse(url="/admin", status_code=303)
         set_admin_cookie(response)  # Set cookie on successful login
@@ -143,86 +211,82 @@ async def login_page(request: Request):
 
 # Admin logout route (clear cookie and upload database)
 @app.get("/admin/logout")
-async def admin_logout(
-    request: Request,
-    # Inject the dependency as a parameter (where FastAPI expects it)
-    backup_trigger: None = BackupOnWrite  
-):
-    # The background task is queued here by FastAPI before execution proceeds.
+async def admin_logout(request: Request):
+    # Logout writes nothing itself; it just uploads the session's pending writes now
+    BACKUP_SCHEDULER.expedite()
     
     response = RedirectResponse(url="/admin/login", status_code=303)
     response.delete_cookie("admin_logged_in")  # Delete cookie on logout
     
-    # We can add a print statement to confirm the action, though the dependency already prints.
     print("👋 Admin logging out. Redirecting.")
     
     return response
 
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_page(request: Request, unpaid_only: Optional[str] = Query(None)):
+async def admin_page(
+    request: Request,
+    unpaid_only: Optional[str] = Query(None),
+    # Import job started by the last CSV upload, passed along by its redirect
+    job_id: Optional[str] = Query(None)
+):
     check_admin_logged_in(request)
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
-
     unpaid_only_flag = unpaid_only == "true"
 
-    summary = conn.execute("""
-        SELECT user_name, user_id, SUM(bill_amount) AS total_unpaid, COUNT(user_id) AS unpaid_count
-        FROM bills 
-        WHERE paid = 0 
-        GROUP BY user_id
-    """).fetchall()
-
-    if unpaid_only_flag:
-        bills = conn.execute("SELECT * FROM bills WHERE paid = 0 ORDER BY user_id, pay_period DESC").fetchall()
-    else:
-        bills = conn.execute("SELECT * FROM bills ORDER BY user_id, pay_period DESC").fetchall()
-
-    conn.close()
-
-    total_unpaid = sum(row['total_unpaid'] for row in summary)
+    async def render():
+        return stream_template("admin.html", {
+            "request": request,
+            "unpaid_only": unpaid_only_flag,
+            "job_id": job_id
+        }, stream_admin_dashboard)
 
-    return templates.TemplateResponse("admin.html", {
-        "request": request,
-        "summary": summary,
-        "bills": bills,
-        "total": total_unpaid,
-        "unpaid_only": unpaid_only_flag
-    })
+    return await cached_page(request, "admin", (unpaid_only_flag, job_id), render)
 
 
 
 # Admin restore db from google drive (if necessary)
 @app.post("/admin/restore")
-async def restore_db_route():
-    success = restore_from_drive()
+async def restore_db_route(request: Request):
+    check_admin_logged_in(request)
+    # An explicit restore downloads even when the fingerprint matches
+    started = DRIVE_RESTORE.start(force=True)
     return {
-        "success": success,
-        "message": "✅ Database restored" if success else "❌ Restore failed"
+        "success": started,
+        "message": "⏳ Restore started" if started else "⏳ A restore is already running"
     }
 
 
+# Progress of the login / manual Drive restore (polled by the dashboard)
+@app.get("/admin/restore_status")
+async def restore_status(request: Request):
+    check_admin_logged_in(request)
+    return DRIVE_RESTORE.status()
+
+
 # Admin update bills route
 @app.post("/admin/update_payment")
 async def update_payment_route(
     request: Request,
     # Inject the dependency here. It queues the background task instantly.
+    background_tasks: BackgroundTasks,
     backup_trigger: None = BackupOnWrite,    
     bill_ids: Optional[List[int]] = Form(None)
 ):
     check_admin_logged_in(request)
     if bill_ids:
-        mark_bills_as_paid(bill_ids)
+        result = await run_db(mark_bills_as_paid, bill_ids)
+        background_tasks.add_task(prerender_receipts, result["paid"])
     return RedirectResponse("/admin", status_code=303)
 
 
 
 @app.post("/admin/update_payment_through_cart")
-async def update_payment_through_cart(request: Request, backup_trigger: None = BackupOnWrite, bill_ids: List[int] = Form(...)):
+async def update_payment_through_cart(request: Request, background_tasks: BackgroundTasks, backup_trigger: None = BackupOnWrite, bill_ids: List[int] = Form(...)):
     try:
         check_admin_logged_in(request)
-        mark_bills_as_paid(bill_ids)  # 🔄 Reused logic
+        result = await run_db(mark_bills_as_paid, bill_ids)  # 🔄 Reused logic
+        # The cart page links every receipt of this batch; have them ready
+        background_tasks.add_task(prerender_receipts, result["paid"])
 
         return RedirectResponse(
             url=f"/admin/shopping_cart?receipt_ids={','.join(map(str, bill_ids))}",
@@ -238,39 +302,12 @@ async def update_payment_through_cart(request: Request, backup_trigger: None = B
 @app.get("/admin/shopping_cart", response_class=HTMLResponse)
 async def shopping_cart(request: Request, receipt_ids: Optional[str] = Query(None)):
     check_admin_logged_in(request)
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
 
     receipt_id_list = []
-    selected_bills = []
-    all_unpaid_bills = []
-
     if receipt_ids:
         receipt_id_list = [int(i) for i in receipt_ids.split(",") if i.isdigit()]
-        placeholders = ",".join(["?"] * len(receipt_id_list))
-        selected_bills = conn.execute(
-            f"SELECT * FROM bills WHERE id IN ({placeholders})",
-            receipt_id_list
-        ).fetchall()
-
-    # Load all unpaid bills for selection (excluding already selected ones)
-    if receipt_id_list:
-        placeholders = ",".join(["?"] * len(receipt_id_list))
-        all_unpaid_bills = conn.execute(
-            f"SELECT * FROM bills WHERE paid = 0 AND id NOT IN ({placeholders})",
-            receipt_id_list
-        ).fetchall()
-    else:
-        all_unpaid_bills = conn.execute("SELECT * FROM bills WHERE paid = 0").fetchall()
 
-    conn.close()
-
-    return templates.TemplateResponse("shopping_cart.html", {
-        "request": request,
-        "selected_bills": selected_bills,
-        "receipt_ids": receipt_id_list,
-        "all_unpaid_bills": all_unpaid_bills,
-    })
+    return stream_template("shopping_cart.html", {"request": request}, stream_shopping_cart, receipt_id_list)
 
 
 
@@ -284,7 +321,7 @@ async def cancel_payment_route(
 ):
     check_admin_logged_in(request)
     if bill_ids_cancel:
-        cancel_bills_payment(bill_ids_cancel)
+        await run_db(cancel_bills_payment, bill_ids_cancel)
     return RedirectResponse("/admin", status_code=303)
 
 
@@ -293,69 +330,63 @@ async def cancel_payment_route(
 async def public_view(request: Request):
     return templates.TemplateResponse("user.html", {"request": request})
 
-# User-specific bills page --- legacy
-@app.get("/user-legacy", response_class=HTMLResponse)
-async def user_view(request: Request, user_id: str):
-    conn = get_db_connection()
-    c = conn.cursor()
+# User-specific bills page --- legacy links now land on the current page
+@app.get("/user-legacy")
+async def user_legacy_view(user_id: str):
+    return RedirectResponse(f"/user?{urlencode({'user_id': user_id})}", status_code=301)
 
-    try:
-        c.execute("SELECT * FROM bills WHERE user_id = ? AND paid = 0", (user_id,))
-        user_data = c.fetchall()
+async def render_user_page(request: Request, user_id: str):
+    """Render /user for ``user_id`` into USER_PAGE_CACHE; returns (body, validator headers)."""
+    generation = USER_PAGE_CACHE.generation
+    # Unpaid bills, or the latest paid bill if there are none
+    user_data, all_paid = await run_db_shared(get_user_bills, user_id)
 
-        return templates.TemplateResponse("user.html", {
+    if not all_paid:
+        response = templates.TemplateResponse("user.html", {
             "request": request,
             "user_id": user_id,
-            "user_data": user_data
+            "user_data": user_data,
+            "all_paid": False
         })
+    else:
+        latest_paid = user_data
+        payment_time = latest_paid[0]['payment_timestamp'] if latest_paid else None
 
-    except sqlite3.Error as e:
-        return templates.TemplateResponse("user.html", {
+        response = templates.TemplateResponse("user.html", {
             "request": request,
             "user_id": user_id,
-            "user_data": [],
-            "error": f"Database error: {str(e)}"
+            "user_data": latest_paid,
+            "payment_timestamp": payment_time,
+            "all_paid": True
         })
 
-    finally:
-        conn.close()
+    # Refreshes revalidate; unchanged bills come back as a bodyless 304
+    response.headers["ETag"] = make_etag(user_id, [tuple(row) for row in user_data])
+    response.headers["Last-Modified"] = http_date(data_version_time())
+    response.headers["Cache-Control"] = "private, no-cache"
+    page = (response.body, _validators(response))
+    USER_PAGE_CACHE.put(user_id, page, generation)
+    return page
+
 
 # Updated user-specific page
 @app.get("/user", response_class=HTMLResponse)
 async def user_view(request: Request, user_id: str):
-    conn = get_db_connection()
-    c = conn.cursor()
+    # Highest-traffic page: served from the per-user cache without a DB round trip
+    cached = USER_PAGE_CACHE.get(user_id)
+    if cached is not None:
+        body, headers = cached
+        return not_modified_or(request, HTMLResponse(body, headers=headers))
 
     try:
-        # Get unpaid bills
-        c.execute("SELECT * FROM bills WHERE user_id = ? AND paid = 0", (user_id,))
-        user_data = c.fetchall()
-
-        if user_data:
-            return templates.TemplateResponse("user.html", {
-                "request": request,
-                "user_id": user_id,
-                "user_data": user_data,
-                "all_paid": False
-            })
-        else:
-            # Get latest paid bill if no unpaid bills
-            c.execute("""
-                SELECT * FROM bills 
-                WHERE user_id = ? AND paid = 1 
-                ORDER BY payment_timestamp DESC 
-                LIMIT 1
-            """, (user_id,))
-            latest_paid = c.fetchall()
-            payment_time = latest_paid[0]['payment_timestamp'] if latest_paid else None
-
-            return templates.TemplateResponse("user.html", {
-                "request": request,
-                "user_id": user_id,
-                "user_data": latest_paid,
-                "payment_timestamp": payment_time,
-                "all_paid": True
-            })
+        # Everyone asking for this user while it renders shares the one render
+        # Keyed on the user's data version, so nobody joins a render older than a payment they saw
+        flight_key = ("user", user_id, user_data_version(user_id))
+        (body, headers), _ = await PAGE_FLIGHTS.do(flight_key, lambda: render_user_page(request, user_id))
+        return not_modified_or(request, HTMLResponse(body, headers=headers))
+
+    except PoolTimeout:
+        raise  # pool_timeout_handler answers 503 so the client retries
 
     except sqlite3.Error as e:
         return templates.TemplateResponse("user.html", {
@@ -365,134 +396,131 @@ async def user_view(request: Request, user_id: str):
             "error": f"Database error: {str(e)}"
         })
 
-    finally:
-        conn.close()
-
 # ====upload csv route
 @app.post("/admin/upload")
 async def upload_csv(request: Request, backup_trigger: None = BackupOnWrite, csv_file: UploadFile = File(...)):
     check_admin_logged_in(request)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    contents = await csv_file.read()
-
-    decoded = contents.decode("utf-8")
-    raw_reader = csv.DictReader(io.StringIO(decoded))
-
-    # Header mapping: CSV header → expected DB column name
-    csv_to_db_keys = {
-        'lvl1_cost': 'lv1_cost',
-        'lvl2_cost': 'lv2_cost',
-        'lvl3_cost': 'lv3_cost',
-        'lvl4_cost': 'lv4_cost',
-        'user_id': 'user_id',
-        'device_id': 'device_id',
-        'user_name': 'user_name',
-        'user_address': 'user_address',
-        'pay_period': 'pay_period',
-        'meter_past': 'meter_past',
-        'meter_now': 'meter_now',
-        'usage': 'usage',
-        'basic_cost': 'basic_cost',
-        'bill_amount': 'bill_amount'
+
+    # Spool the file and hand it to the import worker; the dashboard polls the job.
+    # The worker backs up the database once the import has finished.
+    try:
+        job_id = await run_db(create_import_job, csv_file.file, csv_file.filename)
+    except ImportsPaused:
+        # A restore began after BackupOnWrite let the upload through
+        raise HTTPException(status_code=503, detail="Database restore in progress, try again shortly",
+                            headers={"Retry-After": "10"})
+
+    return RedirectResponse(url=f"/admin?job_id={job_id}", status_code=303)
+
+
+# Keyset-paginated bill listing (paged in by the dashboard)
+@app.get("/admin/api/bills")
+async def bills_api(
+    request: Request,
+    paid: Optional[bool] = Query(None),
+    pay_period: Optional[str] = Query(None),
+    user_id: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    # Free text over user_id, user_name and device_id (see search_bills)
+    q: Optional[str] = Query(None),
+    after_user_id: Optional[str] = Query(None),
+    after_pay_period: Optional[str] = Query(None),
+    after_id: Optional[int] = Query(None),
+    limit: int = Query(BILLS_PAGE_SIZE)
+):
+    check_admin_logged_in(request)
+    after = None
+    if after_id is not None:
+        after = (after_user_id, after_pay_period, after_id)
+
+    rows, next_cursor = await run_db_shared(get_bills_page, paid, pay_period, user_id, after, limit, device_id, q)
+
+    payment_dates = format_timestamps(row["payment_timestamp"] for row in rows)
+    bills = []
+    for row in rows:
+        bill = dict(row)
+        if bill["payment_timestamp"]:
+            bill["payment_date"] = payment_dates[bill["payment_timestamp"]]
+        bills.append(bill)
+
+    next_page = None
+    if next_cursor is not None:
+        next_page = dict(zip(("after_user_id", "after_pay_period", "after_id"), next_cursor))
+    page = {"bills": bills, "next": next_page}
+    # Totals for the whole filtered set, summed in SQL, come with the first page
+    if after is None:
+        page["total"] = await run_db_shared(get_bills_total, paid, pay_period, user_id, device_id, q)
+    return page
+
+
+# Typeahead for the bill search on /admin/update_bill_entry
+@app.get("/admin/api/bill_search")
+async def bill_search_api(request: Request, q: str = Query(""), limit: int = Query(10)):
+    check_admin_logged_in(request)
+    matches = await run_db_shared(search_bills, q, max(1, min(limit, 50)))
+    return {"query": q, "results": [dict(row) for row in matches]}
+
+
+# Page cache effectiveness
+@app.get("/admin/cache_stats")
+async def cache_stats(request: Request):
+    check_admin_logged_in(request)
+    return {
+        **PAGE_CACHE.stats(),
+        "user_pages": USER_PAGE_CACHE.stats(),
+        "receipts": RECEIPT_CACHE.stats(),
+        # Concurrent identical requests that shared one query / render
+        "coalesced_queries": DB_FLIGHTS.stats(),
+        "coalesced_pages": PAGE_FLIGHTS.stats(),
     }
 
-    inserted_count = 0
-    for raw_row in raw_reader:
-        try:
-            # Remap keys using defined mapping
-            row = {}
-            for csv_key, db_key in csv_to_db_keys.items():
-                if csv_key in raw_row:
-                    row[db_key] = raw_row[csv_key].strip()
-                else:
-                    row[db_key] = ""
-
-            user_id = row['user_id']
-            pay_period = row['pay_period']
-
-            # Check for duplicate
-            cursor.execute("SELECT 1 FROM bills WHERE user_id = ? AND pay_period = ?", (user_id, pay_period))
-            if cursor.fetchone():
-                print(f"⚠️ Skipping duplicate: user_id={user_id}, pay_period={pay_period}")
-                continue
-
-            # === Cleaning Functions ===
-            def clean_int(val):
-                val = val.replace('$', '').replace(',', '').strip()
-                return int(float(val or 0))
-
-            def clean_float(val):
-                val = val.replace('$', '').replace(',', '').strip()
-                return round(float(val or 0.0), 2)
-
-            def clean_date_to_mmdd(val):
-                try:
-                    dt = datetime.strptime(val.strip(), "%m/%d/%Y")
-                    return dt.strftime("%m/%d")
-                except:
-                    return val.strip()
-
-            # === Clean fields ===
-            meter_past = clean_int(row['meter_past'])
-            meter_now = clean_int(row['meter_now'])
-            usage = clean_int(row['usage'])
-            lv1_cost = clean_float(row['lv1_cost'])
-            lv2_cost = clean_float(row['lv2_cost'])
-            lv3_cost = clean_float(row['lv3_cost'])
-            lv4_cost = clean_float(row['lv4_cost'])
-            basic_cost = clean_float(row['basic_cost'])
-            bill_amount = clean_float(row['bill_amount'])
-            user_address = clean_date_to_mmdd(row['user_address'])
-
-            # === Insert into DB ===
-            cursor.execute("""
-                INSERT INTO bills (
-                    user_id, device_id, user_name, user_address, pay_period, meter_past, meter_now,
-                    usage, lv1_cost, lv2_cost, lv3_cost, lv4_cost, basic_cost, bill_amount, paid
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-            """, (
-                user_id, row['device_id'], row['user_name'], user_address, pay_period,
-                meter_past, meter_now, usage,
-                lv1_cost, lv2_cost, lv3_cost, lv4_cost,
-                basic_cost, bill_amount
-            ))
-
-            inserted_count += 1
-
-        except Exception as e:
-            print(f"❌ Skipped row due to error: {e}")
-            continue
-
-    conn.commit()
-    conn.close()
-
-    ensure_payment_timestamp_column()
-    ensure_receipt_no_column_exists()
-    print(f"✅ Inserted {inserted_count} new rows from {csv_file.filename}")
-    backup_db()
 
-    return RedirectResponse(url="/admin", status_code=303)
+# Drive backup scheduler: writes waiting for an upload and the last good one
+@app.get("/admin/backup_status")
+async def backup_status(request: Request):
+    check_admin_logged_in(request)
+    return BACKUP_SCHEDULER.stats()
 
 
+# CSV import job progress (polled by the dashboard)
+@app.get("/admin/jobs/{job_id}")
+async def import_job_status(request: Request, job_id: str):
+    check_admin_logged_in(request)
+    job = await run_db_shared(get_import_job, job_id)
+    if job is None:
+        return JSONResponse({"error": "Import job not found"}, status_code=404)
+    return job
+
+
+
+# Recompute stored bills from the tariff and list the ones that disagree
+@app.get("/admin/tariff_check")
+async def tariff_check(request: Request, pay_period: Optional[str] = Query(None)):
+    check_admin_logged_in(request)
+    return await run_db_shared(revalidate_bills, pay_period)
+
 
 # Admin invoice route (view and print invoices)
 @app.get("/admin/invoice/{user_id}", response_class=HTMLResponse)
 async def invoice(request: Request, user_id: str):
     check_admin_logged_in(request)  # Ensure admin is logged in
-    conn = get_db_connection()
-    c = conn.cursor()
 
-    try:
-        c.execute("SELECT * FROM bills WHERE user_id = ? AND paid = 0", (user_id,))
-        user_data = c.fetchall()
+    async def render():
+        user_data, total_unpaid = await run_db_shared(get_invoice, user_id)
 
         return templates.TemplateResponse("invoice.html", {
             "request": request,
             "user_id": user_id,
-            "user_data": user_data
+            "user_data": user_data,
+            "total_unpaid": total_unpaid
         })
 
+    try:
+        return await cached_page(request, "invoice", (user_id,), render)
+
+    except PoolTimeout:
+        raise  # pool_timeout_handler answers 503 so the client retries
+
     except sqlite3.Error as e:
         return templates.TemplateResponse("invoice.html", {
             "request": request,
@@ -501,38 +529,124 @@ async def invoice(request: Request, user_id: str):
             "error": f"Database error: {str(e)}"
         })
 
-    finally:
-        conn.close()
 
+# Every unpaid invoice at once: one printable document (a page per customer)
+# or a ZIP of per-customer pages, rendered while it streams out. Rendered in
+# this process: forking a pool from the server would copy the whole app into
+# every worker (`python bulk_invoices.py --workers N` renders in parallel)
+@app.get("/admin/invoices/bulk")
+async def bulk_invoices(request: Request, format: str = Query("html")):
+    check_admin_logged_in(request)
 
-# receipt of paid bill
-@app.get("/admin/receipt/{bill_id}", response_class=HTMLResponse)
-def show_invoice(request: Request, bill_id: int):
-    check_admin_logged_in(request)  # Ensure admin is logged in
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM bills WHERE id = ?", (bill_id,))
-    bill = cursor.fetchone()
-    conn.close()
+    if format == "zip":
+        filename = f"invoices_{datetime.now(WIB).strftime('%Y%m%d')}.zip"
+        return StreamingResponse(
+            iterate_db(iter_invoice_zip()),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    if format != "html":
+        raise HTTPException(status_code=400, detail="format must be html or zip")
+    return StreamingResponse(iterate_db(iter_invoice_document()), media_type="text/html")
 
+
+# receipt of paid bill
+# A receipt link carries its receipt_no (?r=...), so that URL always names the
+# same payment and browsers may keep it for good; cancelling and re-paying a
+# bill produces a new receipt_no and therefore a new URL.
+RECEIPT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def _paid_at(bill) -> float:
+    if not bill["payment_timestamp"]:
+        return datetime.now(timezone.utc).timestamp()
+    return datetime.strptime(bill["payment_timestamp"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+
+def cache_receipt(bill, template_name: str, generation: int) -> str:
+    """Render a paid bill's receipt and keep it in RECEIPT_CACHE."""
+    body = templates.get_template(template_name).render(bill=bill)
+    RECEIPT_CACHE.put(bill["id"], bill["receipt_no"], template_name, body, _paid_at(bill), generation)
+    return body
+
+
+def prerender_receipts(bill_ids: List[int]) -> int:
+    """Render every receipt of a payment batch ahead of the first print."""
+    if not bill_ids:
+        return 0
+    rendered = 0
+    generation = RECEIPT_CACHE.generation
+    for bill in get_paid_bills(bill_ids):
+        for template_name in RECEIPT_TEMPLATES:
+            if not RECEIPT_CACHE.has(bill["id"], bill["receipt_no"], template_name):
+                cache_receipt(bill, template_name, generation)
+                rendered += 1
+    print(f"🧾 Pre-rendered {rendered} receipts for {len(bill_ids)} bills.")
+    return rendered
+
+
+def receipt_response(request: Request, template_name: str, data: bytes, compressed: bool, paid_at: float, immutable: bool) -> Response:
+    # Compressed entries go out as stored to clients that take gzip
+    headers = {"Vary": "Accept-Encoding"}
+    if compressed and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+    elif compressed:
+        data = gzip.decompress(data)
+        compressed = False
+    headers["ETag"] = make_etag(template_name, data, compressed)
+    headers["Last-Modified"] = http_date(paid_at)
+    headers["Cache-Control"] = RECEIPT_CACHE_CONTROL if immutable else "private, no-cache"
+    response = Response(content=data, media_type="text/html", headers=headers)
+    return not_modified_or(request, response)
+
+
+async def render_receipt(request: Request, template_name: str, bill_id: int, receipt_no: Optional[str]):
+    # A link that names the receipt is answered from disk without touching the database
+    if receipt_no:
+        cached = RECEIPT_CACHE.get(bill_id, receipt_no, template_name)
+        if cached is not None:
+            return receipt_response(request, template_name, *cached, immutable=True)
+
+    generation = RECEIPT_CACHE.generation
+    bill = await run_db_shared(get_bill, bill_id)
     if not bill:
         return HTMLResponse("<h2>Receipt not found.</h2>", status_code=404)
 
-    return templates.TemplateResponse("receipt.html", {"request": request, "bill": bill})
+    if not bill["receipt_no"]:
+        # Unpaid: nothing to keep, the page changes once it is paid
+        response = templates.TemplateResponse(template_name, {"request": request, "bill": bill})
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    immutable = receipt_no == bill["receipt_no"]
+    cached = RECEIPT_CACHE.get(bill_id, bill["receipt_no"], template_name)
+    if cached is None:
+        await run_db(cache_receipt, bill, template_name, generation)
+        cached = RECEIPT_CACHE.get(bill_id, bill["receipt_no"], template_name)
+    if cached is None:
+        # Not cacheable (odd receipt_no or larger than the cache); serve it directly
+        body = templates.get_template(template_name).render(bill=bill).encode("utf-8")
+        cached = (body, False, _paid_at(bill))
+    return receipt_response(request, template_name, *cached, immutable=immutable)
+
+
+@app.get("/admin/receipt/{bill_id}", response_class=HTMLResponse)
+async def show_invoice(request: Request, bill_id: int, r: Optional[str] = Query(None)):
+    check_admin_logged_in(request)  # Ensure admin is logged in
+    return await render_receipt(request, "receipt.html", bill_id, r)
 
 @app.get("/admin/thermal-receipt/{bill_id}", response_class=HTMLResponse)
-def show_invoice(request: Request, bill_id: int):
+async def show_invoice(request: Request, bill_id: int, r: Optional[str] = Query(None)):
     check_admin_logged_in(request)  # Ensure admin is logged in
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM bills WHERE id = ?", (bill_id,))
-    bill = cursor.fetchone()
-    conn.close()
+    return await render_receipt(request, "thermal-receipt.html", bill_id, r)
 
-    if not bill:
-        return HTMLResponse("<h2>Receipt not found.</h2>", status_code=404)
 
-    return templates.TemplateResponse("thermal-receipt.html", {"request": request, "bill": bill})
+# Batch mode: render the receipts of a payment batch before anyone prints them
+@app.post("/admin/receipts/prerender")
+async def prerender_receipts_route(request: Request, bill_ids: List[int] = Form(...)):
+    check_admin_logged_in(request)
+    rendered = await run_db(prerender_receipts, bill_ids)
+    return {"rendered": rendered, "receipts": RECEIPT_CACHE.stats()}
 
 
 
@@ -542,45 +656,26 @@ def show_invoice(request: Request, bill_id: int):
 async def payment_summary(request: Request, start: Optional[str] = Query(None), end: Optional[str] = Query(None), date: Optional[str] = Query(None)):
     check_admin_logged_in(request)
 
-    if date:
-        bills = get_bills_by_date(date)
-        total = sum(b["bill_amount"] for b in bills)
-        return templates.TemplateResponse("payment_summary.html", {
-            "request": request,
-            "mode": "daily_details",
-            "selected_date": date,
-            "bills": bills,
-            "subtotal": total
-        })
-    else:
-        summary = get_daily_payment_summary(start, end)
-        return templates.TemplateResponse("payment_summary.html", {
-            "request": request,
-            "mode": "summary",
-            "summary": summary,
-            "start": start,
-            "end": end
-        })
+    async def render():
+        if date:
+            return stream_template("payment_summary.html", {"request": request}, stream_bills_by_date, date)
+        else:
+            return stream_template("payment_summary.html", {"request": request}, stream_daily_payment_summary, start, end)
+
+    return await cached_page(request, "payment_summary", (start, end, date), render)
 
 # update bill entry route
 @app.get("/admin/update_bill_entry", response_class=HTMLResponse)
 async def render_update_form(request: Request, query: str = None, bill_id: int = None):
     check_admin_logged_in(request)  # Ensure admin is logged in
-    conn = get_db_connection()
     bill = None
     matches = []
 
     if bill_id:
-        bill = conn.execute("SELECT * FROM bills WHERE id = ?", (bill_id,)).fetchone()
+        bill = await run_db_shared(get_bill, bill_id)
     elif query:
-        query_like = f"%{query}%"
-        matches = conn.execute("""
-            SELECT id, user_id, user_name, pay_period FROM bills 
-            WHERE user_id LIKE ? OR user_name LIKE ?
-            ORDER BY id DESC LIMIT 20
-        """, (query_like, query_like)).fetchall()
-
-    conn.close()
+        matches = await run_db_shared(search_bills, query)
+
     return templates.TemplateResponse("update_bill_entry.html", {"request": request, "bill": bill, "matches": matches, "query": query})
 
 
@@ -606,23 +701,13 @@ async def update_bill_entry(
     paid: int = Form(...)
 ):
     try:
-        conn = get_db_connection()
-        conn.execute("""
-            UPDATE bills SET 
-                user_id = ?, device_id = ?, user_name = ?, user_address = ?, pay_period = ?,
-                meter_past = ?, meter_now = ?, usage = ?,
-                lv1_cost = ?, lv2_cost = ?, lv3_cost = ?, lv4_cost = ?,
-                basic_cost = ?, bill_amount = ?, paid = ?
-            WHERE id = ?
-        """, (
-            user_id, device_id, user_name, user_address, pay_period,
-            meter_past, meter_now, usage,
-            lv1_cost, lv2_cost, lv3_cost, lv4_cost,
-            basic_cost, bill_amount, paid,
-            bill_id
-        ))
-        conn.commit()
-        conn.close()
+        await run_db(update_bill, bill_id, {
+            "user_id": user_id, "device_id": device_id, "user_name": user_name,
+            "user_address": user_address, "pay_period": pay_period,
+            "meter_past": meter_past, "meter_now": meter_now, "usage": usage,
+            "lv1_cost": lv1_cost, "lv2_cost": lv2_cost, "lv3_cost": lv3_cost, "lv4_cost": lv4_cost,
+            "basic_cost": basic_cost, "bill_amount": bill_amount, "paid": paid
+        })
         return RedirectResponse(url="/admin/update_bill_entry", status_code=303)
     except Exception as e:
         print(f"⚠️ Error updating bill: {e}")
@@ -633,10 +718,7 @@ async def update_bill_entry(
 async def delete_bill_entry(request: Request, backup_trigger: None = BackupOnWrite, bill_id: int = Form(...)):
     try:
         check_admin_logged_in(request)  # Ensure admin is logged in
-        conn = get_db_connection()
-        conn.execute("DELETE FROM bills WHERE id = ?", (bill_id,))
-        conn.commit()
-        conn.close()
+        await run_db(delete_bill, bill_id)
         print(f"🗑️ Bill ID {bill_id} deleted successfully.")
         return RedirectResponse(url="/admin/update_bill_entry", status_code=303)
     except Exception as e:
@@ -0,0 +1,186 @@
+import os
+import re
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+# Rendered receipts on disk, one file per (bill, receipt_no, template). Once a
+# bill is paid its receipt never changes until the payment is cancelled (or
+# the bill edited), so a reprint is a file read instead of a query + render.
+RECEIPT_CACHE_DIR = os.getenv("RECEIPT_CACHE_DIR", "receipt_cache")
+RECEIPT_CACHE_MAX_BYTES = int(os.getenv("RECEIPT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RECEIPT_CACHE_COMPRESS = os.getenv("RECEIPT_CACHE_COMPRESS", "true").lower() in ("1", "true", "yes")
+RECEIPT_TEMPLATES = ("receipt.html", "thermal-receipt.html")
+
+# receipt_no goes into a file name, so only plain RCP-YYYYMMDD-NNNN style values are cached
+_SAFE_RECEIPT_NO = re.compile(r"[A-Za-z0-9-]+")
+
+
+class ReceiptCache:
+    """Size-bounded LRU of rendered receipts stored as (optionally gzipped) files.
+
+    Each file's mtime is set to the payment time, which get() hands back for
+    Last-Modified.
+
+    The cache lives as long as the process: the database is restored from a
+    backup at every start-up (finish_restore() clears the cache), and the
+    templates may have changed with a deploy, so files left by an earlier
+    process are deleted on first use rather than served.
+
+    As with KeyedCache, callers read ``generation`` before loading the bill
+    and pass it to put(), so a receipt rendered from a row that a cancel has
+    since changed is not stored.
+    """
+
+    def __init__(self, directory: str = RECEIPT_CACHE_DIR, max_bytes: int = RECEIPT_CACHE_MAX_BYTES,
+                 compress: bool = RECEIPT_CACHE_COMPRESS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._entries: Optional[OrderedDict] = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _filename(self, bill_id: int, receipt_no: str, template_name: str, compressed: bool) -> str:
+        stem = template_name.rsplit(".", 1)[0]
+        return f"{bill_id}.{receipt_no}.{stem}.html" + (".gz" if compressed else "")
+
+    def _load(self):
+        # Called with the lock held; the first time only, removes receipts left by an earlier process
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        stale = 0
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if (len(parts) in (4, 5) and parts[0].isdigit() and parts[3] == "html") or name.endswith(".tmp"):
+                self._remove_file(name)
+                stale += 1
+        self._entries = OrderedDict()
+        if stale:
+            print(f"🧾 Receipt cache: removed {stale} receipts left in {self.directory}")
+
+    def has(self, bill_id: int, receipt_no: str, template_name: str) -> bool:
+        with self._lock:
+            self._load()
+            return (bill_id, receipt_no, template_name) in self._entries
+
+    def get(self, bill_id: int, receipt_no: str, template_name: str) -> Optional[Tuple[bytes, bool, float]]:
+        """Return ``(data, compressed, paid_at)`` or None; ``data`` is gzip when ``compressed``."""
+        key = (bill_id, receipt_no, template_name)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = os.path.join(self.directory, entry[0])
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            paid_at = os.stat(path).st_mtime
+        except OSError:
+            # Removed behind our back; forget it and let the caller re-render
+            self._discard([key])
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data, entry[0].endswith(".gz"), paid_at
+
+    def put(self, bill_id: int, receipt_no: str, template_name: str, body: str, paid_at: float, generation: int):
+        if not receipt_no or not _SAFE_RECEIPT_NO.fullmatch(receipt_no):
+            return
+        data = body.encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6, mtime=0)
+        if len(data) > self.max_bytes:
+            return
+        name = self._filename(bill_id, receipt_no, template_name, self.compress)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+        # Written under a temporary name so a reader never sees half a file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.utime(tmp_path, (paid_at, paid_at))
+        os.replace(tmp_path, path)
+
+        key = (bill_id, receipt_no, template_name)
+        with self._lock:
+            if generation != self.generation:
+                os.remove(path)
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+                if previous[0] != name:
+                    self._remove_file(previous[0])
+            self._entries[key] = (name, len(data))
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                _, (evicted, size) = self._entries.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                self._remove_file(evicted)
+
+    def _remove_file(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _discard(self, keys: Iterable[tuple]) -> int:
+        removed = 0
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+                    self._remove_file(entry[0])
+                    removed += 1
+        return removed
+
+    def evict_bills(self, bill_ids: Iterable[int]) -> int:
+        """Drop every cached receipt of ``bill_ids``; call when a payment is cancelled or a bill edited."""
+        bill_ids = set(bill_ids)
+        if not bill_ids:
+            return 0
+        with self._lock:
+            self._load()
+            keys = [key for key in self._entries if key[0] in bill_ids]
+        removed = self._discard(keys)
+        self.evictions += removed
+        return removed
+
+    def clear(self):
+        """Drop everything, e.g. after a restore brought back a different database."""
+        with self._lock:
+            self._load()
+            keys = list(self._entries)
+        self.evictions += self._discard(keys)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries or ()),
+                "bytes": self._bytes,
+                "compressed": self.compress,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+RECEIPT_CACHE = ReceiptCache()
@@ -0,0 +1,232 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Dict, Hashable, Iterable, Mapping, Optional
+
+# Rendered pages are cached in memory under a global data version. Every write
+# to the bills data bumps the version, so a cached page can never outlive the
+# rows it was rendered from.
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "512"))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+USER_PAGE_CACHE_MAX_ENTRIES = int(os.getenv("USER_PAGE_CACHE_MAX_ENTRIES", "10000"))
+
+_data_version = 0
+_data_version_time = time.time()
+_version_lock = threading.Lock()
+# Per-customer versions for /user; _all_users_version moves when a write
+# does not say whose bills it touched
+_user_data_versions: Dict[str, int] = {}
+_all_users_version = 0
+
+
+def data_version() -> int:
+    return _data_version
+
+
+def user_data_version(user_id: str) -> tuple:
+    """Changes whenever a write touches ``user_id``'s bills."""
+    return (_all_users_version, _user_data_versions.get(user_id, 0))
+
+
+def data_version_time() -> float:
+    """When the data last changed (process start if it has not since)."""
+    return _data_version_time
+
+
+def bump_data_version(user_ids: Optional[Iterable[str]] = None) -> int:
+    """Invalidate cached pages; call after a write has committed.
+
+    ``user_ids`` names the customers whose bills the write touched; their
+    /user pages are dropped from USER_PAGE_CACHE. None drops all of them.
+    """
+    global _data_version, _data_version_time, _all_users_version
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    with _version_lock:
+        if user_ids is None:
+            _all_users_version += 1
+        else:
+            for user_id in user_ids:
+                _user_data_versions[user_id] = _user_data_versions.get(user_id, 0) + 1
+    if user_ids is None:
+        USER_PAGE_CACHE.clear()
+    else:
+        USER_PAGE_CACHE.invalidate(user_ids)
+    with _version_lock:
+        _data_version += 1
+        _data_version_time = time.time()
+        return _data_version
+
+
+class ResponseCache:
+    """LRU cache of rendered bodies, bounded by entry count and total size.
+
+    Keys end with the data version they were rendered at; entries from an
+    older version are dropped as soon as a newer one is seen.
+    """
+
+    def __init__(self, max_entries: int = PAGE_CACHE_MAX_ENTRIES, max_bytes: int = PAGE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, route: str, *params: Hashable) -> tuple:
+        return (route, params, data_version())
+
+    def _drop_stale(self, version: int):
+        if version > self._version:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key: tuple) -> Optional[Any]:
+        with self._lock:
+            self._drop_stale(key[-1])
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, body: Any, size: Optional[int] = None):
+        """Store ``body``; ``size`` defaults to len(body) and counts towards max_bytes."""
+        size = len(body) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Rendered before a write landed: the page is already stale
+            if key[-1] != data_version():
+                return
+            self._drop_stale(key[-1])
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (body, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "data_version": data_version(),
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class KeyedCache:
+    """LRU cache whose entries are invalidated one key at a time.
+
+    Callers read ``generation`` before loading a value and pass it to put();
+    if any invalidation ran in between, the value may predate the write and
+    is not stored.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+PAGE_CACHE = ResponseCache()
+# Rendered /user pages by user_id; unlike PAGE_CACHE, a payment by one
+# customer leaves everyone else's page cached
+USER_PAGE_CACHE = KeyedCache(USER_PAGE_CACHE_MAX_ENTRIES)
+
+
+# === Conditional GET ===
+def make_etag(*parts) -> str:
+    """Strong ETag from the row values a page was rendered from."""
+    return '"' + hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def is_not_modified(request_headers: Mapping[str, str], response_headers: Mapping[str, str]) -> bool:
+    """True when the client's copy still matches the ETag / Last-Modified we would send."""
+    etag = response_headers.get("etag")
+    if_none_match = request_headers.get("if-none-match")
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    last_modified = response_headers.get("last-modified")
+    if_modified_since = request_headers.get("if-modified-since")
+    if last_modified is None or if_modified_since is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,54 @@
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into one in-flight computation.
+
+    The first caller for a key starts the work; callers arriving while it
+    runs await the same result instead of repeating it. Nothing is kept once
+    the work finishes, so this never serves stale data - it only collapses
+    requests that overlap in time (e.g. billing-day rushes on one user_id).
+
+    Keys are tuples whose first item names the call, which is what the
+    per-name counters in stats() are grouped by.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.executed = Counter()
+        self.coalesced = Counter()
+
+    async def do(self, key: Tuple, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return ``(result, shared)``; ``shared`` is True for callers that piggybacked."""
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced[key[0]] += 1
+        else:
+            self.executed[key[0]] += 1
+            # A task of its own, so a caller that disconnects does not cancel
+            # the work for everyone else waiting on it
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Mark the error as seen even if every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        names = sorted(self.executed.keys() | self.coalesced.keys())
+        return {
+            "in_flight": len(self._in_flight),
+            "executed": sum(self.executed.values()),
+            "coalesced": sum(self.coalesced.values()),
+            "by_name": {
+                name: {"executed": self.executed[name], "coalesced": self.coalesced[name]}
+                for name in names
+            },
+        }
@@ -0,0 +1,162 @@
+import os
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from database_utils import db_connection
+
+# Tier boundaries (m³) and rates (Rp per m³) as printed on receipts:
+# 0–10 @1,000, 11–20 @1,000, 21–30 @2,500, 31+ @4,000.
+# basic_cost None means "use the basic_cost carried by the bill row".
+DEFAULT_TARIFF = {"bounds": [10, 20, 30], "rates": [1000, 1000, 2500, 4000], "basic_cost": None}
+
+# Optional per-period overrides: {"default": {...}, "Jan-24": {...}, ...}
+TARIFF_CONFIG_PATH = os.getenv("TARIFF_CONFIG", "app/db/tariffs.json")
+
+# Amounts are whole rupiah; anything beyond rounding noise is a real difference
+AMOUNT_TOLERANCE = 0.5
+
+_config_cache = {}
+
+
+def load_tariffs(path: str = TARIFF_CONFIG_PATH) -> Dict[str, Dict]:
+    """Tariffs keyed by pay_period, plus "default"; re-read only when the file changes."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {"default": DEFAULT_TARIFF}
+
+    if _config_cache.get("key") != (path, mtime):
+        with open(path, encoding="utf-8") as f:
+            tariffs = json.load(f)
+        tariffs.setdefault("default", DEFAULT_TARIFF)
+        for period, tariff in tariffs.items():
+            if len(tariff["bounds"]) != 3 or len(tariff["rates"]) != 4:
+                raise ValueError(f"Tariff '{period}' needs 3 bounds and 4 rates (one per lvN_cost column)")
+        _config_cache.update(key=(path, mtime), tariffs=tariffs)
+    return _config_cache["tariffs"]
+
+
+def compute_bills(usage, pay_periods, basic_cost, tariffs: Optional[Dict[str, Dict]] = None):
+    """Tier costs and totals for whole arrays of bills at once.
+
+    Returns ``(tier_costs, totals)``: an (n, 4) array matching lv1_cost..lv4_cost
+    and an (n,) array matching bill_amount.
+    """
+    tariffs = tariffs or load_tariffs()
+    usage = np.asarray(usage, dtype=np.float64)
+    basic_cost = np.asarray(basic_cost, dtype=np.float64)
+
+    # One row per tariff in use, then each bill points at its period's row
+    periods, period_index = np.unique(np.asarray(pay_periods, dtype=str), return_inverse=True)
+    table = [tariffs.get(period, tariffs["default"]) for period in periods]
+    lower = np.array([[0, *t["bounds"]] for t in table], dtype=np.float64)
+    upper = np.array([[*t["bounds"], np.inf] for t in table], dtype=np.float64)
+    rates = np.array([t["rates"] for t in table], dtype=np.float64)
+    fixed_basic = np.array([np.nan if t.get("basic_cost") is None else t["basic_cost"] for t in table])
+
+    volumes = np.clip(usage[:, None] - lower[period_index], 0, (upper - lower)[period_index])
+    tier_costs = volumes * rates[period_index]
+    basic = np.where(np.isnan(fixed_basic[period_index]), basic_cost, fixed_basic[period_index])
+    totals = tier_costs.sum(axis=1) + basic
+    return tier_costs, totals
+
+
+def find_mismatches(usage, pay_periods, tier_costs, basic_cost, bill_amount, tariffs=None):
+    """Flag bills whose stored tier costs or total differ from the tariff.
+
+    A missing (NULL / NaN) usage, cost or amount is flagged too. Returns
+    ``(mask, expected_totals)``.
+    """
+    expected_tiers, expected_totals = compute_bills(usage, pay_periods, basic_cost, tariffs)
+    tier_costs = np.asarray(tier_costs, dtype=np.float64).reshape(-1, 4)
+    bill_amount = np.asarray(bill_amount, dtype=np.float64)
+    # NaN compares False against the tolerance, so missing values are checked on their own
+    mask = (
+        (np.abs(expected_tiers - tier_costs) > AMOUNT_TOLERANCE).any(axis=1)
+        | (np.abs(expected_totals - bill_amount) > AMOUNT_TOLERANCE)
+        | np.isnan(tier_costs).any(axis=1)
+        | np.isnan(bill_amount)
+        | np.isnan(expected_totals)
+    )
+    return mask, expected_totals
+
+
+def find_batch_mismatches(batch: List[tuple]) -> List[int]:
+    """Check a batch of SQL_INSERT_BILL parameter tuples from the CSV ingest path.
+
+    Returns the positions in ``batch`` of the rows that differ from the tariff.
+    """
+    if not batch:
+        return []
+    # Tuple layout follows database_utils.BILL_IMPORT_COLUMNS
+    columns = list(zip(*batch))
+    mask, _ = find_mismatches(
+        usage=columns[7],
+        pay_periods=columns[4],
+        tier_costs=np.column_stack(columns[8:12]),
+        basic_cost=columns[12],
+        bill_amount=columns[13],
+    )
+    return np.flatnonzero(mask).tolist()
+
+
+def revalidate_bills(pay_period: Optional[str] = None, limit: int = 100) -> Dict:
+    """Check every stored bill (or one pay period) against the tariff.
+
+    Returns the number of bills checked, how many differ, and up to ``limit``
+    of the differing bills with their computed total.
+    """
+    query = """
+        SELECT id, user_id, pay_period, usage, lv1_cost, lv2_cost, lv3_cost, lv4_cost, basic_cost, bill_amount
+        FROM bills
+    """
+    params = ()
+    if pay_period:
+        query += " WHERE pay_period = ?"
+        params = (pay_period,)
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Plain tuples convert to arrays far faster than sqlite3.Row
+        rows = cursor.execute(query, params).fetchall()
+    if not rows:
+        return {"checked": 0, "mismatched": 0, "bills": []}
+
+    columns = list(zip(*rows))
+    ids, user_ids, periods = columns[0], columns[1], columns[2]
+    # NULL columns become NaN; find_mismatches() flags them
+    numbers = np.array(columns[3:], dtype=np.float64)
+    usage, tier_costs, basic_cost, bill_amount = numbers[0], numbers[1:5].T, numbers[5], numbers[6]
+
+    mask, expected_totals = find_mismatches(usage, periods, tier_costs, basic_cost, bill_amount)
+    flagged = np.flatnonzero(mask)[:limit]
+    return {
+        "checked": len(rows),
+        "mismatched": int(mask.sum()),
+        "bills": [
+            {
+                "id": ids[i],
+                "user_id": user_ids[i],
+                "pay_period": periods[i],
+                # NaN is not valid JSON; a NULL stays null
+                "bill_amount": None if np.isnan(bill_amount[i]) else float(bill_amount[i]),
+                "computed_amount": None if np.isnan(expected_totals[i]) else float(expected_totals[i]),
+            }
+            for i in flagged
+        ],
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python tariff.py [pay_period]
+    result = revalidate_bills(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Checked {result['checked']} bills, {result['mismatched']} differ from the tariff.")
+    for bill in result["bills"]:
+        stored, computed = (f"{value:,.0f}" if value is not None else "NULL"
+                            for value in (bill["bill_amount"], bill["computed_amount"]))
+        print(f"  #{bill['id']} {bill['user_id']} {bill['pay_period']}: stored {stored}, computed {computed}")
+    sys.exit(1 if result["mismatched"] else 0)
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The app modules live at the repository root and resolve paths relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import database_utils
+from receipt_cache import RECEIPT_CACHE
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """database_utils pointed at a fresh, migrated database under tmp_path."""
+    monkeypatch.setattr(database_utils, "DB_PATH", str(tmp_path / "bills.db"))
+    monkeypatch.setattr(database_utils, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(RECEIPT_CACHE, "directory", str(tmp_path / "receipt_cache"))
+    database_utils.migrate_db()
+    yield database_utils
+    database_utils.close_db_pool()
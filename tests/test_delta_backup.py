@@ -0,0 +1,107 @@
+import gzip
+import os
+
+import pytest
+
+import delta_backup
+from delta_backup import LocalDirStore, restore_delta_backup, ship_delta_backup
+
+
+@pytest.fixture
+def store(db, tmp_path, monkeypatch):
+    """A LocalDirStore standing in for Drive, with delta state kept under tmp_path."""
+    backup_dir = str(tmp_path / "backups")
+    monkeypatch.setattr(delta_backup, "DB_PATH", db.DB_PATH)
+    monkeypatch.setattr(delta_backup, "BACKUP_DIR", backup_dir)
+    monkeypatch.setattr(delta_backup, "STATE_PATH", os.path.join(backup_dir, "delta_state.json"))
+    monkeypatch.setattr(delta_backup, "HASHES_PATH", os.path.join(backup_dir, "delta_pages.bin"))
+    return LocalDirStore(str(tmp_path / "drive"))
+
+
+def add_bills(db, start, count):
+    with db.db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO bills (user_id, user_name, pay_period, bill_amount) VALUES (?, ?, ?, ?)",
+            [(f"u{i}", f"Name {i}" * 20, "Jan-24", 15000 + i) for i in range(start, start + count)],
+        )
+
+
+def all_bills(db):
+    with db.db_connection() as conn:
+        return [tuple(row) for row in conn.execute("SELECT * FROM bills ORDER BY id")]
+
+
+def ship_chain(db, store, deltas):
+    add_bills(db, 0, 500)
+    assert ship_delta_backup(store)
+    for n in range(deltas):
+        add_bills(db, 1000 * (n + 1), 50)
+        with db.db_connection() as conn:
+            conn.execute("UPDATE bills SET paid = 1 WHERE id = ?", (n + 1,))
+        assert ship_delta_backup(store)
+
+
+def test_base_and_deltas_restore_the_shipped_database(db, store):
+    ship_chain(db, store, deltas=3)
+    shipped = all_bills(db)
+    assert len(store.list(delta_backup.DELTA_PREFIX)) == 3
+
+    with db.db_connection() as conn:
+        conn.execute("DELETE FROM bills")
+    assert restore_delta_backup(store, force=True)
+    assert all_bills(db) == shipped
+
+
+def test_restore_refuses_a_chain_with_a_missing_delta(db, store):
+    ship_chain(db, store, deltas=3)
+    second = store.list(delta_backup.DELTA_PREFIX)[1]
+    os.remove(os.path.join(store.directory, second))
+    with db.db_connection() as conn:
+        conn.execute("DELETE FROM bills")
+
+    assert not restore_delta_backup(store, force=True)
+    assert all_bills(db) == []
+
+
+def test_out_of_sequence_segment_is_rejected(db, store, tmp_path):
+    ship_chain(db, store, deltas=2)
+    base_name, deltas = delta_backup.chain_tip(store)
+    rebuilt = str(tmp_path / "rebuilt.db")
+    delta_backup.rebuild_latest(store, rebuilt, (base_name, []))
+    segment = str(tmp_path / "segment.bin.gz")
+    store.download(deltas[1], segment)
+
+    # The base followed straight by the second delta
+    with pytest.raises(ValueError, match="expected seq 1, found 2"):
+        delta_backup.apply_segment(rebuilt, segment, expected_seq=1)
+
+
+def test_restore_is_skipped_when_the_local_state_is_the_chain_tip(db, store):
+    ship_chain(db, store, deltas=1)
+    stages = []
+
+    assert restore_delta_backup(store, progress=lambda stage, fraction=None: stages.append(stage))
+    assert "skipped" in stages
+    assert "downloading" not in stages
+
+
+def test_bases_are_compressed(db, store):
+    ship_chain(db, store, deltas=0)
+    (base_name,) = store.list(delta_backup.BASE_PREFIX)
+    assert base_name.endswith(".db.gz")
+    path = os.path.join(store.directory, base_name)
+    with gzip.open(path) as f:
+        assert os.path.getsize(path) < len(f.read())
+
+
+def test_retention_drops_a_base_together_with_its_deltas(store):
+    for base_id in ("20260101100000", "20260101103000", "20260101110000"):
+        for name in (f"bills_base_{base_id}.db.gz", f"bills_delta_{base_id}_00001.bin.gz",
+                     f"bills_delta_{base_id}_00002.bin.gz"):
+            open(os.path.join(store.directory, name), "wb").close()
+
+    delta_backup.prune_delta_chains(store)
+    # The 10:00 chain is superseded within its hour by the 10:30 one
+    assert not [name for name in os.listdir(store.directory) if "20260101100000" in name]
+    assert len(store.list(delta_backup.BASE_PREFIX)) == 2
+    assert len(store.list(delta_backup.DELTA_PREFIX)) == 4
@@ -0,0 +1,50 @@
+import csv
+import sqlite3
+
+HEADER = ("user_id,device_id,user_name,user_address,pay_period,meter_past,meter_now,usage,"
+          "lvl1_cost,lvl2_cost,lvl3_cost,lvl4_cost,basic_cost,bill_amount")
+
+
+def csv_rows(count):
+    lines = [HEADER] + [
+        f"u{i},d{i},Name {i},01/01/2024,Jan-24,100,110,10,10000,0,0,0,5000,15000" for i in range(count)
+    ]
+    return csv.DictReader(lines)
+
+
+def test_checkpointed_import_releases_the_write_lock_between_batches(db):
+    blocked = []
+
+    def rows_with_a_payment_in_between():
+        for i, row in enumerate(csv_rows(25)):
+            if i == 15:
+                # A cashier write while the import reads ahead; must not wait on the import
+                other = sqlite3.connect(db.DB_PATH, timeout=0)
+                try:
+                    other.execute("UPDATE bills SET paid = 1 WHERE user_id = 'u0'")
+                    other.commit()
+                except sqlite3.OperationalError as e:
+                    blocked.append(str(e))
+                finally:
+                    other.close()
+            yield row
+
+    counts = db.import_bill_rows(rows_with_a_payment_in_between(), batch_size=10,
+                                 checkpoint=lambda conn, counts: None)
+    assert blocked == []
+    assert counts["inserted"] == 25
+    with db.db_connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT paid FROM bills WHERE user_id = 'u0'").fetchone()[0] == 1
+
+
+def test_import_records_which_rows_differ_from_the_tariff(db):
+    from tariff import find_batch_mismatches
+
+    rows = list(csv_rows(25))
+    for row in rows[12:14]:
+        row["bill_amount"] = "99999"
+
+    counts = db.import_bill_rows(rows, batch_size=10, validate_batch=find_batch_mismatches)
+    assert counts["tariff_mismatches"] == 2
+    assert [(r["row"], r["user_id"]) for r in counts["tariff_mismatch_rows"]] == [(13, "u12"), (14, "u13")]
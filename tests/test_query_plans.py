@@ -0,0 +1,13 @@
+def test_hot_queries_use_an_index(db):
+    assert db.find_table_scans() == {}
+
+
+def test_missing_indexes_are_reported(db):
+    # Guards the check itself: without the bills indexes it must notice the scans
+    with db.db_connection() as conn:
+        indexes = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'bills' AND sql IS NOT NULL"
+        ).fetchall()
+        for (name,) in indexes:
+            conn.execute(f"DROP INDEX {name}")
+    assert "bills_by_date" in db.find_table_scans()
@@ -0,0 +1,20 @@
+import os
+
+from receipt_cache import ReceiptCache
+
+
+def test_receipts_left_by_an_earlier_process_are_not_served(tmp_path):
+    earlier = ReceiptCache(str(tmp_path))
+    earlier.put(1, "RCP-20240101-0001", "receipt.html", "<p>old template</p>", 0, earlier.generation)
+    assert os.listdir(tmp_path)
+
+    cache = ReceiptCache(str(tmp_path))
+    assert cache.get(1, "RCP-20240101-0001", "receipt.html") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_put_then_get_round_trips(tmp_path):
+    cache = ReceiptCache(str(tmp_path), compress=False)
+    cache.put(1, "RCP-20240101-0001", "receipt.html", "<p>receipt</p>", 1700000000, cache.generation)
+    data, compressed, paid_at = cache.get(1, "RCP-20240101-0001", "receipt.html")
+    assert (data, compressed, paid_at) == (b"<p>receipt</p>", False, 1700000000)
@@ -0,0 +1,15 @@
+from response_cache import bump_data_version, data_version, user_data_version
+
+
+def test_user_data_version_moves_only_for_touched_users():
+    a, b = user_data_version("a"), user_data_version("b")
+    bump_data_version(["a"])
+    assert user_data_version("a") != a
+    assert user_data_version("b") == b
+
+
+def test_unscoped_write_moves_every_user_version():
+    version, b = data_version(), user_data_version("b")
+    bump_data_version()
+    assert data_version() == version + 1
+    assert user_data_version("b") != b
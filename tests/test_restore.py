@@ -0,0 +1,79 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+
+def add_bill(db, user_id):
+    with db.db_connection() as conn:
+        conn.execute("INSERT INTO bills (user_id, pay_period, bill_amount) VALUES (?, 'Jan-24', 15000)", (user_id,))
+
+
+def bill_users(db):
+    with db.db_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT user_id FROM bills ORDER BY id")]
+
+
+def replacement(db, tmp_path, user_ids):
+    """A copy of the current database holding bills for ``user_ids``."""
+    db.checkpoint_db()
+    path = str(tmp_path / "replacement.db")
+    shutil.copyfile(db.DB_PATH, path)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO bills (user_id, pay_period, bill_amount) VALUES (?, 'Jan-24', 15000)",
+                     [(user_id,) for user_id in user_ids])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_swap_waits_for_an_in_flight_write(db, tmp_path):
+    new_path = replacement(db, tmp_path, ["restored"])
+    in_write, finish_write = threading.Event(), threading.Event()
+
+    def slow_write():
+        # e.g. mark_bills_as_paid() between borrowing its connection and BEGIN IMMEDIATE
+        with db.db_connection() as conn:
+            in_write.set()
+            finish_write.wait(5)
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO bills (user_id, pay_period, bill_amount) VALUES ('late', 'Jan-24', 1)")
+
+    writer = threading.Thread(target=slow_write)
+    writer.start()
+    in_write.wait(5)
+    swap = threading.Thread(target=db.replace_db, args=(new_path,))
+    swap.start()
+    swap.join(0.3)
+    assert swap.is_alive() and os.path.exists(new_path)
+
+    finish_write.set()
+    writer.join(5)
+    swap.join(5)
+    assert not swap.is_alive()
+    assert bill_users(db) == ["restored"]
+
+
+def test_writes_wait_until_the_swapped_in_database_is_ready(db, tmp_path, monkeypatch):
+    new_path = replacement(db, tmp_path, ["restored"])
+    finishing, finished = threading.Event(), threading.Event()
+    finish_restore = db.finish_restore
+
+    def slow_finish_restore():
+        finish_restore()
+        finishing.set()
+        finished.wait(5)
+
+    monkeypatch.setattr(db, "finish_restore", slow_finish_restore)
+    swap = threading.Thread(target=db.replace_db, args=(new_path,))
+    swap.start()
+    finishing.wait(5)
+    writer = threading.Thread(target=add_bill, args=(db, "after"))
+    writer.start()
+    writer.join(0.3)
+    assert writer.is_alive()
+
+    finished.set()
+    swap.join(5)
+    writer.join(5)
+    assert bill_users(db) == ["restored", "after"]